@@ -18,8 +18,51 @@
 #
 ######################################################################
 
+import argparse
+import getpass
+import mmap
+import multiprocessing
+import os
 import random
+import re
 import sys
+import time
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of characters every rotor maps, ASCII 32 through 126.
+ALPHABET_SIZE = 95
+
+# Number of values every rotor maps in byte mode, which encrypts any data, 0 through 255.
+BYTE_ALPHABET_SIZE = 256
+
+# How many compiled keys compile_key() keeps around before dropping the least recently used one.
+KEY_CACHE_SIZE = 128
+
+# Messages shorter than this go through the plain Python loop even when NumPy is installed, since setting up the
+# arrays costs more than it saves.
+NUMPY_MIN_LENGTH = 256
+
+# How much of a file stream_file() reads at a time.
+CHUNK_SIZE = 64 * 1024
+
+# How many characters each worker process is handed at a time by parallel_process().
+PARALLEL_CHUNK_SIZE = 256 * 1024
+
+# How much of a file the command line tool encrypts at a time. Big chunks give NumPy more to work with per call.
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# Added to the names of files the command line tool encrypts, and taken off again when they are decrypted.
+ENCRYPTED_SUFFIX = ".enigma"
+
+# Every byte outside of ASCII 32 through 126, which clean_text() strips out.
+_unprintable_bytes = "".join(chr(x) for x in range(256) if not 32 <= x < 127)
+_unprintable = re.compile(u'[^\x20-\x7e]')
 
 class Rotor():
     ''' A rotor is simply a list with the numbers 0 through 94 which represent the various letters and punctuation in
@@ -77,6 +120,368 @@ class Rotor():
         #Returned as character
         return self.to_character(index)
 
+# The rotor wirings never change; only the key decides where each one starts. Rotor number n is always the n-th
+# shuffle made after seeding the generator with 42, so the tables are generated once, in order, and shared by
+# every key. Byte mode rotors are shuffled the same way from their own generator.
+_rotor_random = {ALPHABET_SIZE: random.Random(42), BYTE_ALPHABET_SIZE: random.Random(42)}
+_forward_tables = {ALPHABET_SIZE: [], BYTE_ALPHABET_SIZE: []}
+_inverse_tables = {ALPHABET_SIZE: [], BYTE_ALPHABET_SIZE: []}
+_tables_lock = Lock()
+
+_key_cache = OrderedDict()
+_key_cache_lock = Lock()
+
+def rotor_tables(count, size=ALPHABET_SIZE):
+    ''' Returns the forward and inverse wiring tables for the first count rotors. The tables are built with the same
+    shuffle Rotor.set_rotor() uses, so rotor n here is wired exactly like the n-th Rotor built after random.seed(42).
+    size picks between the text rotors and the byte mode ones. '''
+    with _tables_lock:
+        forward_tables = _forward_tables[size]
+        inverse_tables = _inverse_tables[size]
+        while len(forward_tables) < count:
+            characters = range(size)
+            forward = []
+            for x in range(size):
+                index = _rotor_random[size].randint(0, len(characters) - 1)
+                forward.append(characters[index])
+                del(characters[index])
+
+            inverse = [0] * size
+            for (i, val) in enumerate(forward):
+                inverse[val] = i
+
+            forward_tables.append(forward)
+            inverse_tables.append(inverse)
+
+        return forward_tables[:count], inverse_tables[:count]
+
+class EnigmaKey():
+    ''' A key compiled into rotor tables. Instead of physically shifting a list on every key press, each rotor keeps a
+    fixed wiring table and an integer offset, so a rotation is an addition and looking a character up in either
+    direction is a single index into a table. Use compile_key() rather than building these directly so that the
+    tables for a key are only built once. '''
+
+    # How many values each rotor maps, and the character the first of them stands for.
+    size = ALPHABET_SIZE
+    first = 32
+
+    def __init__(self, key):
+        self.key = key
+        self.forward, self.inverse = rotor_tables(len(key), self.size)
+
+        # Rotating a Rotor by ord(character) positions leaves it ord(character) % 95 steps from its wiring.
+        self.offsets = [ord(x) % self.size for x in key]
+
+        # Rotor j rotates every 95 ** j characters.
+        self.periods = [self.size ** j for j in range(len(key))]
+
+        # NumPy copies of the tables, built the first time a long message comes through.
+        self.forward_array = None
+        self.inverse_array = None
+
+    def encrypt(self, text, start=0):
+        ''' Encrypts already cleaned text. Gives the same output as feeding every character through the Rotor objects
+        one after the other. start is the position of the first character of text within the whole message. '''
+        if numpy is not None and len(text) >= NUMPY_MIN_LENGTH:
+            return self.encrypt_numpy(text, start)
+        return self.encrypt_python(text, start)
+
+    def decrypt(self, text, start=0):
+        ''' Decrypts already cleaned text, the first character of which sits at position start in the message. '''
+        if numpy is not None and len(text) >= NUMPY_MIN_LENGTH:
+            return self.decrypt_numpy(text, start)
+        return self.decrypt_python(text, start)
+
+    def offsets_at(self, position):
+        ''' Returns the offset of every rotor just before character number position is typed. Rotor j has turned once
+        for every multiple of 95 ** j below position. '''
+        return [(offset + (position + period - 1) // period) % self.size
+                for (offset, period) in zip(self.offsets, self.periods)]
+
+    def encrypt_python(self, text, start=0):
+        ''' Encrypts one character at a time, stepping the rotor offsets as it goes. '''
+        forward = self.forward
+        offsets = self.offsets_at(start)
+        (size, first) = (self.size, self.first)
+        rotors = range(len(forward))
+        output = []
+
+        for (i, val) in enumerate(text, start):
+            val = ord(val) - first
+            for j in rotors:
+                val = forward[j][(val + offsets[j]) % size]
+            self.step(offsets, i)
+            output.append(chr(val + first))
+
+        return "".join(output)
+
+    def decrypt_python(self, text, start=0):
+        ''' Decrypts one character at a time by passing it backwards through the inverse tables. '''
+        inverse = self.inverse
+        offsets = self.offsets_at(start)
+        (size, first) = (self.size, self.first)
+        rotors = range(len(inverse))[::-1]
+        output = []
+
+        for (i, val) in enumerate(text, start):
+            val = ord(val) - first
+            for j in rotors:
+                val = (inverse[j][val] - offsets[j]) % size
+            self.step(offsets, i)
+            output.append(chr(val + first))
+
+        return "".join(output)
+
+    def step(self, offsets, i):
+        ''' Rotates the rotors after character number i has been typed. A rotor only turns when every rotor before it
+        has turned as well, so we can stop at the first one that doesn't. '''
+        for (j, period) in enumerate(self.periods):
+            if i % period != 0:
+                break
+            offsets[j] = (offsets[j] + 1) % self.size
+
+    def rotor_positions(self, length, start=0, index=None):
+        ''' Yields every rotor number along with a NumPy array of the offset that rotor has while each of the length
+        characters from position start onwards is typed. Rotor j has turned once for every multiple of 95 ** j below
+        the character index, so the offsets can be worked out directly instead of by stepping through the message.
+        index can be given instead, as an array of the position of every character within its own message. '''
+        if index is None:
+            index = numpy.arange(start, start + length, dtype=numpy.int64)
+        end = int(index.max()) + 1 if len(index) else 0
+
+        # Rotors that turn less often than once per message only turn after the first character.
+        after_first = (index > 0).astype(numpy.int64)
+
+        for (j, period) in enumerate(self.periods):
+            if period < end:
+                turns = (index + (period - 1)) // period
+            else:
+                turns = after_first
+            yield j, (turns + self.offsets[j]) % self.size
+
+    def load_arrays(self):
+        ''' Builds the NumPy versions of the wiring tables. '''
+        if self.forward_array is None:
+            self.forward_array = numpy.array(self.forward, dtype=numpy.int64).reshape(len(self.forward), self.size)
+            self.inverse_array = numpy.array(self.inverse, dtype=numpy.int64).reshape(len(self.inverse), self.size)
+
+    def encrypt_numpy(self, text, start=0, index=None):
+        ''' Encrypts the whole message one rotor at a time using array lookups. The output is identical to
+        encrypt_python(). '''
+        self.load_arrays()
+        values = numpy.frombuffer(str(text), dtype=numpy.uint8).astype(numpy.int64) - self.first
+        for (j, offsets) in self.rotor_positions(len(values), start, index):
+            values = self.forward_array[j][(values + offsets) % self.size]
+        return (values + self.first).astype(numpy.uint8).tostring()
+
+    def decrypt_numpy(self, text, start=0, index=None):
+        ''' Decrypts the whole message one rotor at a time, starting from the last rotor. '''
+        self.load_arrays()
+        values = numpy.frombuffer(str(text), dtype=numpy.uint8).astype(numpy.int64) - self.first
+        for (j, offsets) in reversed(list(self.rotor_positions(len(values), start, index))):
+            values = (self.inverse_array[j][values] - offsets) % self.size
+        return (values + self.first).astype(numpy.uint8).tostring()
+
+    def process_messages(self, messages, encrypt):
+        ''' Encrypts or decrypts a list of separate, already cleaned messages, each of which starts with the rotors
+        back in their first position, and returns the results in a list. With NumPy they all go through the array
+        lookups together, so lots of short messages cost about as much as one long one. '''
+        if numpy is None or sum(len(x) for x in messages) < NUMPY_MIN_LENGTH:
+            convert = self.encrypt if encrypt else self.decrypt
+            return [convert(x) for x in messages]
+
+        lengths = numpy.array([len(x) for x in messages], dtype=numpy.int64)
+        ends = numpy.cumsum(lengths)
+        index = numpy.arange(ends[-1], dtype=numpy.int64) - numpy.repeat(ends - lengths, lengths)
+        text = "".join(messages)
+        output = self.encrypt_numpy(text, index=index) if encrypt else self.decrypt_numpy(text, index=index)
+        return [output[x - y:x] for (x, y) in zip(ends.tolist(), lengths.tolist())]
+
+class ByteKey(EnigmaKey):
+    ''' A key for byte mode. The rotors map all 256 byte values, so any data, newlines and binary files included,
+    comes back out exactly as it went in. The cipher text is binary as well. '''
+    size = BYTE_ALPHABET_SIZE
+    first = 0
+
+def compile_key(key, binary=False):
+    ''' Returns the EnigmaKey for a key, or the ByteKey if binary is set, building it the first time it's needed.
+    The most recently used keys are kept so that repeatedly encrypting or decrypting with the same session key
+    doesn't rebuild its rotors. '''
+    with _key_cache_lock:
+        compiled = _key_cache.pop((key, binary), None)
+        if compiled is not None:
+            _key_cache[(key, binary)] = compiled
+            return compiled
+
+    compiled = ByteKey(key) if binary else EnigmaKey(key)
+
+    with _key_cache_lock:
+        _key_cache[(key, binary)] = compiled
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+
+    return compiled
+
+def clean_text(text):
+    ''' Removes every character that the rotors can't encrypt, which is anything outside of ASCII 32 through 126. '''
+    if isinstance(text, str):
+        return text.translate(None, _unprintable_bytes)
+    return _unprintable.sub(u'', text)
+
+class EnigmaStream():
+    ''' Encrypts or decrypts a message that arrives a piece at a time. The rotor position is carried over from one
+    chunk to the next, so feeding a message through in any number of chunks gives the same output as encrypting it
+    in one go. Only the current chunk is ever held in memory. In binary mode every byte is kept and encrypted with
+    the byte mode rotors. '''
+    def __init__(self, key, encrypt, binary=False):
+        self.key = compile_key(key, binary)
+        self.encrypt = encrypt
+        self.binary = binary
+        self.position = 0
+
+    def seek(self, position):
+        ''' Moves the rotors to character number position of the message. Nothing before it has to be processed
+        first, since the rotor offsets only depend on the position. '''
+        self.position = position
+
+    def update(self, chunk):
+        ''' Takes the next chunk of the message, either bytes or text, and returns its encrypted or decrypted form.
+        Characters the rotors can't handle are dropped the same way Enigma.clean() drops them. '''
+        if not self.binary:
+            chunk = clean_text(chunk)
+        start = self.position
+        self.position += len(chunk)
+
+        if self.encrypt:
+            return self.key.encrypt(chunk, start)
+        return self.key.decrypt(chunk, start)
+
+def stream_file(source, key, encrypt, chunk_size=CHUNK_SIZE, binary=False):
+    ''' Reads a file-like object chunk_size characters at a time and yields the encrypted or decrypted chunks. '''
+    stream = EnigmaStream(key, encrypt, binary)
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+
+        output = stream.update(chunk)
+        if output:
+            yield output
+
+def process_chunk(job):
+    ''' Encrypts or decrypts one piece of a message inside a worker process. job is a (key, encrypt, text, start)
+    tuple so that it can be handed to Pool.map(). '''
+    (key, encrypt, text, start) = job
+    if encrypt:
+        return compile_key(key).encrypt(text, start)
+    return compile_key(key).decrypt(text, start)
+
+def parallel_process(text, key, encrypt, pool=None, processes=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    ''' Encrypts or decrypts a large message by splitting it into chunks and handing them out to a pool of worker
+    processes. Every chunk starts at a known position, so the joined output is identical to doing the whole message
+    in one process. Pass in a multiprocessing.Pool to reuse one across calls, otherwise one with processes workers
+    (every core by default) is started for this message. '''
+    text = clean_text(text)
+    jobs = [(key, encrypt, text[x:x + chunk_size], x) for x in range(0, len(text), chunk_size)]
+
+    if len(jobs) < 2:
+        return "".join(process_chunk(x) for x in jobs)
+
+    if pool is not None:
+        return "".join(pool.map(process_chunk, jobs))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return "".join(pool.map(process_chunk, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+def read_chunks(source, chunk_size=FILE_CHUNK_SIZE):
+    ''' Yields the contents of a file object chunk_size bytes at a time. Regular files are memory mapped, so the
+    chunks are copied straight out of the page cache. Pipes, empty files and anything else that can't be mapped are
+    read the normal way. '''
+    try:
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        data = None
+
+    if data is None:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    try:
+        for x in xrange(0, len(data), chunk_size):
+            yield data[x:x + chunk_size]
+    finally:
+        data.close()
+
+def process_stream(source, target, key, encrypt, binary=False, lines=False, chunk_size=FILE_CHUNK_SIZE):
+    ''' Encrypts or decrypts everything in one file object into another and returns how many bytes were read. The
+    output is the same as the Enigma class gives for the whole input as one message. With lines set, every line is a
+    message of its own, the way the relay stores them, and the line breaks are kept, so a chat export can be
+    decrypted in one go. '''
+    size = 0
+    if not lines:
+        stream = EnigmaStream(key, encrypt, binary)
+        for chunk in read_chunks(source, chunk_size):
+            size += len(chunk)
+            target.write(stream.update(chunk))
+        return size
+
+    cipher = compile_key(key)
+    # The start of a line that carries on into the next chunk.
+    partial = []
+    for chunk in read_chunks(source, chunk_size):
+        size += len(chunk)
+        end = chunk.rfind("\n")
+        if end < 0:
+            partial.append(chunk)
+            continue
+        messages = [clean_text(x) for x in ("".join(partial) + chunk[:end]).split("\n")]
+        partial = [chunk[end + 1:]]
+        target.write("\n".join(cipher.process_messages(messages, encrypt)) + "\n")
+
+    rest = clean_text("".join(partial))
+    if rest:
+        target.write(cipher.process_messages([rest], encrypt)[0])
+    return size
+
+def output_path(path, encrypt, output_dir=None):
+    ''' Returns where the command line tool writes the result for a file. Encrypting adds .enigma to the name, and
+    decrypting takes it off again, or adds .plain if it isn't there. '''
+    if encrypt:
+        name = path + ENCRYPTED_SUFFIX
+    elif path.endswith(ENCRYPTED_SUFFIX):
+        name = path[:-len(ENCRYPTED_SUFFIX)]
+    else:
+        name = path + ".plain"
+
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
+
+def process_file(job):
+    ''' Encrypts or decrypts one file for the command line tool. job is a (path, target path, key, encrypt, binary,
+    lines) tuple so that it can be handed to a worker process. Returns (path, bytes read, seconds taken, error), where
+    error is None if it worked. '''
+    (path, target_path, key, encrypt, binary, lines) = job
+    started = time.time()
+    try:
+        with open(path, "rb") as source:
+            with open(target_path, "wb") as target:
+                size = process_stream(source, target, key, encrypt, binary, lines)
+    except EnvironmentError as e:
+        return (path, 0, time.time() - started, str(e))
+    return (path, size, time.time() - started, None)
+
+def throughput(size, elapsed):
+    return "%d bytes in %.2f seconds (%.1f MB/s)" % (size, elapsed, size / max(elapsed, 1e-6) / 1024 / 1024)
+
 class Enigma():
     ''' Creates an Enigma object which initializes all the necessary rotors based on the key that's given and either
     encrypts or decrypts the message based on the desired outcome. '''
@@ -100,51 +505,27 @@ class Enigma():
         self.rotors = rotors[:]
 
     def clean(self):
-        good_chars = [x for x in range(32, 127)]
-        cleaned = ""
-        for x in self.plain_text:
-            if ord(x) in good_chars:
-                cleaned += x
-        self.plain_text = cleaned
-
-        cleaned = ""
-        for x in self.cipher_text:
-            if ord(x) in good_chars:
-                cleaned += x
-        self.cipher_text = cleaned
+        self.plain_text = clean_text(self.plain_text)
+        self.cipher_text = clean_text(self.cipher_text)
 
     def encrypt(self):
         ''' Encrypts the message by inserting the first character into the first rotor, the output of the first
          rotor into the second, the output of the second into the third etc. Each rotor is rotated every 1, 95, 190
          characters, depending on the rotor order. '''
-        self.set_rotors() # The rotors must be reset each time
         self.clean()
-        output = ""
-        for (i, val) in enumerate(self.plain_text):
-            for (j, x) in enumerate(self.rotors):
-                val = x.next_index(val)
-                if i % (95 ** j) == 0:
-                    x.rotate()
-            output += val
-        self.cipher_text = output
+        self.cipher_text = compile_key(self.key).encrypt(self.plain_text)
 
     def decrypt(self):
         ''' Decrypts by reversing the process in the encrypt function. The character starts at the last rotor and
          makes it's way to teh first. '''
-        self.set_rotors()
         self.clean()
-        output = ""
-        for (i, val) in enumerate(self.cipher_text):
-            for x in self.rotors[::-1]:
-                val = x.prev_index(val)
-            for (j, x) in enumerate(self.rotors):
-                if i % (95 ** j) == 0:
-                    x.rotate()
-            output += val
-        self.plain_text = output
+        self.plain_text = compile_key(self.key).decrypt(self.cipher_text)
 
 
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(run_command_line(sys.argv[1:]))
+
     message = raw_input("Message: ")
 
     key = raw_input("Key: ")
@@ -159,6 +540,85 @@ def main():
     print "+---------- Cipher Text ----------+ \n" + enigma.cipher_text + "\n"
     print "+---------- Plain  Text ----------+ \n" + enigma.plain_text + "\n"
 
+def run_command_line(arguments):
+    ''' Encrypts or decrypts files, or standard input to standard output, and reports how fast it went on standard
+    error. Several files are worked on at once, one per process. Returns the exit status. '''
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("files", nargs="*", help="Files to process. Leave out, or give -, to read standard input and "
+                                                  "write to standard output.")
+    options.add_argument("--key", default=os.environ.get("ENIGMA_KEY"),
+                         help="The key. Defaults to $ENIGMA_KEY, and is asked for if that isn't set either.")
+    options.add_argument("--binary", action="store_true",
+                         help="Keeps every byte, line breaks and binary data included, the way /send_file does.")
+    options.add_argument("--lines", action="store_true",
+                         help="Treats every line as its own message, the way the relay stores them.")
+    options.add_argument("--output-dir", help="Where to write the results. Defaults to next to each file.")
+    options.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                         help="How many files to work on at once.")
+
+    parser = argparse.ArgumentParser(description="Encrypts or decrypts files with the same cipher as the chat.")
+    commands = parser.add_subparsers(dest="mode")
+    commands.add_parser("encrypt", parents=[options], help="Encrypts files.")
+    commands.add_parser("decrypt", parents=[options], help="Decrypts files.")
+    args = parser.parse_args(arguments)
+
+    if args.binary and args.lines:
+        parser.error("--binary and --lines can't be used together")
+    key = args.key
+    if key is None:
+        key = getpass.getpass("Key: ")
+    encrypt = args.mode == "encrypt"
+
+    if not args.files or args.files == ["-"]:
+        started = time.time()
+        size = process_stream(sys.stdin, sys.stdout, key, encrypt, args.binary, args.lines)
+        sys.stdout.flush()
+        print >> sys.stderr, "Processed %s." % throughput(size, time.time() - started)
+        return 0
+
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    jobs = [(x, output_path(x, encrypt, args.output_dir), key, encrypt, args.binary, args.lines) for x in args.files]
+
+    started = time.time()
+    pool = None
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+        results = pool.imap_unordered(process_file, jobs)
+    else:
+        results = (process_file(x) for x in jobs)
+
+    (total, failed) = (0, 0)
+    try:
+        for (path, size, elapsed, error) in results:
+            if error is not None:
+                print >> sys.stderr, "%s: %s" % (path, error)
+                failed += 1
+                continue
+            total += size
+            print >> sys.stderr, "%s: %s." % (path, throughput(size, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print >> sys.stderr, "Processed %d files, %s." % (len(jobs) - failed, throughput(total, time.time() - started))
+    return 1 if failed else 0
+
+def reference_encrypt(text, key):
+    ''' Encrypts text by physically rotating Rotor objects, the way the original machine does it. Only used to check
+    that compiled keys give exactly the same output. '''
+    enigma = Enigma("", key, True)
+    enigma.set_rotors()
+    output = ""
+    for (i, val) in enumerate(text):
+        for (j, x) in enumerate(enigma.rotors):
+            val = x.next_index(val)
+            if i % (95 ** j) == 0:
+                x.rotate()
+        output += val
+    return output
+
 def testit(did_pass):
     """ Print the result of a unit test. """
     # This function works correctly--it is verbatim from the text
@@ -188,6 +648,55 @@ def test():
 
     testit(cipher1.plain_text == cipher2.plain_text)
 
+    # Compiled keys have to match the rotor machine exactly, including after the second rotor turns over.
+    long_text = "".join(chr(32 + (x * 7) % 95) for x in range(9100))
+    testit(compile_key("abc").encrypt(long_text) == reference_encrypt(long_text, "abc"))
+    testit(compile_key("abc").decrypt(compile_key("abc").encrypt(long_text)) == long_text)
+    testit(compile_key("secret key") is compile_key("secret key"))
+
+    if numpy is not None:
+        key = compile_key("a much longer key with lots of rotors")
+        testit(key.encrypt_numpy(long_text) == key.encrypt_python(long_text))
+        testit(key.decrypt_numpy(long_text) == key.decrypt_python(long_text))
+        messages = [long_text[:x] for x in range(0, 9100, 700)]
+        testit(key.process_messages(messages, False) == [key.decrypt_python(x) for x in messages])
+
+    # Streaming a message in uneven chunks has to give the same cipher text as encrypting it all at once.
+    stream = EnigmaStream("abc", True)
+    chunks = [long_text[:10], long_text[10:9000], "\n\t", long_text[9000:]]
+    testit("".join(stream.update(x) for x in chunks) == compile_key("abc").encrypt(long_text))
+    testit(clean_text("Hi\tthere\n\xff") == "Hithere")
+
+    # Starting part way through a message, or spreading it over several processes, can't change the output.
+    stream = EnigmaStream("abc", True)
+    stream.seek(9000)
+    testit(stream.update(long_text[9000:]) == compile_key("abc").encrypt(long_text)[9000:])
+    testit(parallel_process(long_text, "abc", True, processes=2, chunk_size=1000) == compile_key("abc").encrypt(long_text))
+    testit(clean_text(u"Hi\u2603 there") == u"Hi there")
+
+    # Byte mode has to give back every byte value, newlines included, however the data is split up.
+    data = "".join(chr(x % 256) for x in range(70000))
+    cipher = compile_key("abc", True).encrypt(data)
+    testit(len(cipher) == len(data) and compile_key("abc", True).decrypt(cipher) == data)
+    stream = EnigmaStream("abc", False, True)
+    testit(stream.update(cipher[:1000]) + stream.update(cipher[1000:]) == data)
+
+    # Files have to come out the same as the Enigma class, whether they are memory mapped or read from a pipe, and
+    # however the chunks fall across lines.
+    from StringIO import StringIO
+    import tempfile
+    export = "".join("%d\thello number %d\n" % (x, x) for x in range(500))
+    source = tempfile.TemporaryFile()
+    source.write(export)
+    source.seek(0)
+    target = StringIO()
+    process_stream(source, target, "abc", True, chunk_size=1000)
+    testit(target.getvalue() == Enigma(export, "abc", True).cipher_text)
+    target = StringIO()
+    process_stream(StringIO(export), target, "abc", True, lines=True, chunk_size=7)
+    messages = target.getvalue().split("\n")
+    testit(messages[:-1] == [Enigma(x, "abc", True).cipher_text for x in export.split("\n")[:-1]])
+
 
 
     '''car = " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
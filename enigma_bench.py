@@ -0,0 +1,234 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Measures how fast the cipher and the relay server are. The cipher benchmark times Enigma over a range of
+#          message and key lengths. The load benchmark starts a local server and has a number of simulated users send,
+#          receive and check messages against it at the same time. Results can be saved as JSON and compared with an
+#          earlier run.
+#
+######################################################################
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import enigma
+from enigma import Enigma
+from enigma_client import Client
+
+MESSAGE_LENGTHS = [100, 1000, 10000, 100000]
+KEY_LENGTHS = [1, 3, 10, 30]
+
+# Each cipher measurement is repeated until it has taken at least this many seconds.
+MIN_SECONDS = 0.2
+
+def percentile(values, fraction):
+    ''' Returns the value the given fraction of a sorted list falls under. '''
+    if not values:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def time_it(function):
+    ''' Calls function until MIN_SECONDS have gone by and returns the average time per call. '''
+    runs = 0
+    started = time.time()
+    while True:
+        function()
+        runs += 1
+        elapsed = time.time() - started
+        if elapsed >= MIN_SECONDS:
+            return elapsed / runs
+
+def bench_cipher(message_lengths=MESSAGE_LENGTHS, key_lengths=KEY_LENGTHS):
+    ''' Times encrypting and decrypting with Enigma for every combination of message and key length. '''
+    results = []
+    for key_length in key_lengths:
+        key = "".join(chr(33 + (x * 13) % 94) for x in range(key_length))
+        for message_length in message_lengths:
+            plain_text = "".join(chr(32 + (x * 7) % 95) for x in range(message_length))
+            cipher_text = Enigma(plain_text, key, True).cipher_text
+
+            encrypt = time_it(lambda: Enigma(plain_text, key, True))
+            decrypt = time_it(lambda: Enigma(cipher_text, key, False))
+            result = {
+                'key_length': key_length,
+                'message_length': message_length,
+                'numpy': enigma.numpy is not None and message_length >= enigma.NUMPY_MIN_LENGTH,
+                'encrypt_chars_per_second': message_length / encrypt,
+                'decrypt_chars_per_second': message_length / decrypt,
+            }
+            results.append(result)
+            print "key %3d chars, message %7d chars: encrypt %12.0f chars/s, decrypt %12.0f chars/s" % (
+                key_length, message_length, result['encrypt_chars_per_second'], result['decrypt_chars_per_second'])
+    return results
+
+def free_port():
+    ''' Asks the operating system for a port nobody is listening on. '''
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port):
+    ''' Starts enigma_server.py in its own process and waits until it accepts connections. '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "enigma_server.py")
+    with open(os.devnull, "w") as devnull:
+        # Rate limits are turned off so the benchmark measures what the server can do rather than the limit.
+        server = subprocess.Popen([sys.executable, path, "--port", str(port), "--rate-limit", "0"], stdout=devnull)
+
+    for x in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("The server didn't start")
+
+class User():
+    ''' A simulated chat user that sends messages to one user and reads the messages another one sends it, the same
+    way the chat client does. '''
+    def __init__(self, name, dest_user, source_user, ip, port, key):
+        self.client = Client(name, key, dest_user, port=port, ip=ip)
+        self.source_user = source_user
+        self.latency = {'send': [], 'receive': [], 'check': []}
+        self.received = 0
+        self.errors = 0
+
+    def timed(self, operation, request):
+        started = time.time()
+        try:
+            response = self.client.send(request)
+        except socket.error:
+            self.errors += 1
+            return ""
+        self.latency[operation].append(time.time() - started)
+        return response
+
+    def run(self, deadline, message):
+        client = self.client
+        while time.time() < deadline:
+            cipher = Enigma(message, client.key, True).cipher_text
+            self.timed('send', "send\n%s\n%s\n%s" % (client.dest_user, client.user, cipher))
+
+            response = self.timed('receive', "receive\n%s\n%s" % (client.user, self.source_user))
+            if response.startswith("200"):
+                messages = response.split("\n")[1:-1]
+                for x in messages:
+                    Enigma(x, client.key, False)
+                self.received += len(messages)
+
+            self.timed('check', "check\n%s" % client.user)
+        client.close()
+
+def bench_load(users=10, duration=5.0, message_length=100, ip=None, port=None):
+    ''' Runs users simulated users against a server for duration seconds and reports the latency of every request
+    type and how many messages got through per second. A local server is started unless ip and port are given. '''
+    server = None
+    if ip is None:
+        ip = '127.0.0.1'
+        port = free_port()
+        server = start_server(port)
+
+    message = "".join(chr(32 + (x * 7) % 95) for x in range(message_length))
+    names = ["bench%d" % x for x in range(users)]
+    simulated = [User(names[x], names[(x + 1) % users], names[x - 1], ip, port, "bench key") for x in range(users)]
+
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=x.run, args=(deadline, message)) for x in simulated]
+    started = time.time()
+    try:
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    elapsed = time.time() - started
+
+    result = {'users': users, 'duration': elapsed, 'message_length': message_length, 'operations': {}}
+    for operation in ('send', 'receive', 'check'):
+        latency = sorted(sum((x.latency[operation] for x in simulated), []))
+        result['operations'][operation] = {
+            'count': len(latency),
+            'per_second': len(latency) / elapsed,
+            'p50': percentile(latency, 0.5),
+            'p99': percentile(latency, 0.99),
+        }
+        print "%-8s %8d requests %10.1f/s  p50 %8.2f ms  p99 %8.2f ms" % (
+            operation, len(latency), len(latency) / elapsed, percentile(latency, 0.5) * 1000,
+            percentile(latency, 0.99) * 1000)
+
+    result['messages_delivered'] = sum(x.received for x in simulated)
+    result['messages_per_second'] = result['messages_delivered'] / elapsed
+    result['errors'] = sum(x.errors for x in simulated)
+    print "%d messages delivered, %.1f messages/s, %d errors" % (
+        result['messages_delivered'], result['messages_per_second'], result['errors'])
+    return result
+
+def compare(old, new):
+    ''' Prints how each throughput number changed between two saved runs. '''
+    print "+---------- Compared with the previous run ----------+"
+    old_cipher = dict(((x['key_length'], x['message_length']), x) for x in old.get('cipher', []))
+    for x in new.get('cipher', []):
+        before = old_cipher.get((x['key_length'], x['message_length']))
+        if before is not None:
+            print "key %3d, message %7d: encrypt %+6.1f%%, decrypt %+6.1f%%" % (
+                x['key_length'], x['message_length'],
+                change(before['encrypt_chars_per_second'], x['encrypt_chars_per_second']),
+                change(before['decrypt_chars_per_second'], x['decrypt_chars_per_second']))
+
+    if 'load' in old and 'load' in new:
+        print "messages/s %+6.1f%%" % change(old['load']['messages_per_second'], new['load']['messages_per_second'])
+        for operation in new['load']['operations']:
+            before = old['load']['operations'].get(operation)
+            after = new['load']['operations'][operation]
+            if before is not None:
+                print "%-8s p50 %+6.1f%%, p99 %+6.1f%%" % (operation, change(before['p50'], after['p50']),
+                                                          change(before['p99'], after['p99']))
+
+def change(before, after):
+    ''' Percentage change from before to after. '''
+    if before == 0:
+        return 0.0
+    return (after - before) * 100.0 / before
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the enigma cipher and relay server.")
+    parser.add_argument("benchmark", nargs="?", choices=["cipher", "load", "all"], default="all")
+    parser.add_argument("--users", type=int, default=10, help="Simulated users for the load benchmark.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds the load benchmark runs for.")
+    parser.add_argument("--message-length", type=int, default=100, help="Characters per message in the load run.")
+    parser.add_argument("--ip", help="Benchmark an already running server instead of starting one.")
+    parser.add_argument("--port", type=int, default=5005, help="Port of the server given with --ip.")
+    parser.add_argument("--output", help="File to save the results to as JSON.")
+    parser.add_argument("--compare", help="Results file from an earlier run to compare against.")
+    args = parser.parse_args()
+
+    results = {'time': time.time(), 'python': sys.version.split()[0], 'numpy': enigma.numpy is not None}
+    if args.benchmark in ("cipher", "all"):
+        print "+---------- Cipher ----------+"
+        results['cipher'] = bench_cipher()
+    if args.benchmark in ("load", "all"):
+        print "+---------- Relay load ----------+"
+        results['load'] = bench_load(args.users, args.duration, args.message_length, args.ip,
+                                     args.port if args.ip else None)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -10,42 +10,92 @@
 #
 ######################################################################
 
+import argparse
 import socket
-from enigma import Enigma
+from enigma import Enigma, EnigmaStream, stream_file
+from enigma_history import History
+from enigma_keysearch import KeySearch, load_candidates
+from enigma_protocol import GROUP_PREFIX, FramedConnection, ProtocolError
+from enigma_session import ChatSession
+from enigma_shard import parse_shards
+from itertools import groupby
+import os
+from Queue import Queue, Empty
 import sys
-from threading import Thread
+from threading import Lock, Thread
 import time
 
 # Server Codes:
 # Command (0-9), Response(00-99)
 # 1 - send
 # 100- Message sent
-# 101- Message not sent
+# 101- Message not sent (followed by how many were stored, for a batch)
 # 2- receive
 # 200 messages received
 # 201 no messages to receive
 # 202 error
+# 3 - admission
+# 300 server busy, try again later
+
+# Messages typed within this many seconds of each other are sent to the server in one request.
+COALESCE_DELAY = 0.05
+
+# Most messages sent in one request.
+MAX_BATCH = 100
+
+# Seconds to wait before sending again when the server says it is busy, and how many times to try.
+BUSY_DELAY = 1
+BUSY_RETRIES = 5
+
+# Bytes of a file sent to the server per request.
+FILE_CHUNK = 256 * 1024
+
+def safe_file_name(name):
+    ''' Returns the part of a file name someone sent that is safe to save under in the current directory, or None if
+    nothing is. Names come from the other user, so anything that would reach into another directory or be a hidden
+    file is left out. '''
+    name = os.path.basename(name)
+    if name == "" or name.startswith(".") or "\0" in name:
+        return None
+    return name
 
 class Client():
     ''' The Client object handles sending and receiving messages from the server '''
 
-    def __init__(self, user, key, dest_user, port=5005, ip="127.0.0.1", buffer=2048):
-        ''' Initializes the client with a username, key, and all the  necesary connection variables. '''
+    def __init__(self, user, key, dest_user, port=5005, ip="127.0.0.1", buffer=2048, shards=None, spill_dir=None,
+                 trace_sample=0.0):
+        ''' Initializes the client with a username, key, and all the  necesary connection variables. Passing a list
+        of (host, port) as shards talks to a sharded relay directly instead of a single server. Given a spill_dir,
+        old messages are moved to a temporary file there instead of being kept in memory. trace_sample is the
+        fraction of sent messages that are traced on their way to the recipient. '''
         self.port = port
         self.ip = ip
         self.buffer = buffer
-        self.messages = []
+        self.history = History(spill_dir=spill_dir)
         self.user = user
-        self.key = key
-        self.dest_user = dest_user
         self.active = True
 
+        # Every request and every pushed message goes over the session's one connection. Each person or group has
+        # their own key, and messages are decrypted with it on the session's worker threads.
+        self.session = ChatSession(user, key, ip, port, shards, handler=self.show_message, trace_sample=trace_sample)
+        (self.ip, self.port) = (self.session.ip, self.session.port)
+        self.output_lock = Lock()
+
+        # The person or group messages are sent to, and the key used with them.
+        self.dest_user = dest_user
+        self.key = self.session.conversation(dest_user, key).key
+
+        # Encrypted messages waiting to be sent, as (dest user, cipher text).
+        self.outbox = Queue()
+        self.sender = None
+
         self.server_responses = {
             '100': 'Message Sent',
             '101': 'Error Sending Message',
             '200': 'Message(s) received',
             '201': 'No new messages',
-            '202': 'Error receiving messages'
+            '202': 'Error receiving messages',
+            '300': 'The server is busy, try again later'
         }
 
         # List of commands the user can enter in the client.
@@ -53,59 +103,124 @@ class Client():
             '/get': ['get_messages', 'Receives your messages.'],
             '/display': ['display_messages', 'Displays all the messages that you have received.'],
             '/decrypt': ['decrypt_message', 'Decrypts a specific message and displays the plain text.'],
+            '/search_key': ['search_key', 'Tries a list of keys against a message to recover it.'],
             '/help': ['show_commands', 'Shows a list of all the available commands.'],
             '/history': ['chat_history', 'Shows the plaintext for all the messages in this session.'],
-            '/set_key': ['change_key', 'Changes the conversation key for the session.'],
+            '/set_key': ['change_key', 'Changes the key for the person you are talking to.'],
             '/change_recipient': ['change_recipient', 'Changes the username of the person you are talking to.'],
+            '/conversations': ['list_conversations', 'Lists everyone you have talked to this session.'],
+            '/join': ['join_group', 'Joins a group conversation. Group names start with #.'],
+            '/leave': ['leave_group', 'Leaves a group conversation.'],
+            '/members': ['group_members', 'Lists the members of the group you are talking to.'],
+            '/send_file': ['send_file', 'Encrypts a file and sends it to the person you are talking to.'],
+            '/files': ['list_files', 'Lists the files that have been sent to you.'],
+            '/get_file': ['get_file', 'Downloads and decrypts a file that has been sent to you.'],
+            '/trace': ['show_trace', 'Shows how long traced messages took at each stage of their delivery.'],
+            '/save_trace': ['save_trace', 'Saves the delivery timings of traced messages to a JSON file.'],
             '/exit': ['exit', 'Closes the application.'],
             '/check': ['check_messages', 'Checks to see if any new messages have been recieved from anyone other than the person you are talking to.']
         }
 
     def send(self, message):
-        ''' Sends a message to the server using sockets. '''
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.ip, self.port))
-        s.send(message)
-        response = s.recv(self.buffer)
-        s.close()
-
-        return response
+        ''' Sends a request to the server and returns the response. '''
+        return self.session.request(message)
 
     def send_message(self, message):
-        ''' Encrypts a message and sends it to a specified user. '''
-
-        cipher = Enigma(message, self.key, True)
+        ''' Encrypts a message and queues it to be sent to the current dest user. Messages typed in quick succession
+        go to the server together. '''
 
-        to_send = "%s\n%s\n%s\n%s" % ("send", self.dest_user, self.user, cipher.cipher_text)
-        response = self.send(to_send)
+        self.outbox.put((self.dest_user, self.session.encrypt(self.dest_user, message)))
 
-    def get_messages(self):
-        ''' Downloads and displays all of the messages that have recently been recieved by the current user. '''
-        to_send = "%s\n%s\n%s" % ("receive", self.user, self.dest_user)
-        response = self.send(to_send)
-
-        response = response.split('\n')
+        if self.sender is None:
+            self.sender = Thread(target = self.deliver)
+            self.sender.daemon = True
+            self.sender.start()
 
-        # If new messages have been recieved, prints out the sender and the message
-        if response[0] == '200':
-            messages = response[1:]
-            messages.pop()
-            for x in messages:
-                cipher = Enigma(x, self.key, False)
-                self.messages.append({'sender': self.dest_user, 'cipher_text': x, 'plain_text': cipher.plain_text})
+    def deliver(self):
+        ''' Sends queued messages. After the first message comes in, waits a moment for more so that they can all go
+        in one send_batch request per dest user. '''
+        while self.active:
+            batch = [self.outbox.get()]
+            deadline = time.time() + COALESCE_DELAY
+            while len(batch) < MAX_BATCH:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.outbox.get(timeout = remaining))
+                except Empty:
+                    break
+
+            for (dest_user, messages) in groupby(batch, lambda x: x[0]):
+                to_send = "\n".join(["send_batch", dest_user, self.user] + [x[1] for x in messages])
+                for attempt in range(BUSY_RETRIES):
+                    try:
+                        response = self.send(to_send)
+                    except (socket.error, ProtocolError):
+                        response = "101"
+                    if response != "300":
+                        break
+                    # Sending too fast, so back off and let the rate limit catch up.
+                    time.sleep(BUSY_DELAY * (attempt + 1))
+
+                if response == "300":
+                    print self.server_responses['300']
+                elif response != "100":
+                    print self.server_responses['101']
+
+            for x in batch:
+                self.outbox.task_done()
+
+    def flush(self):
+        ''' Waits until every queued message has been sent. '''
+        self.outbox.join()
 
-                print "%s: %s" % (self.dest_user, cipher.plain_text)
+    def get_messages(self):
+        ''' Downloads and displays all of the messages that have recently been recieved by the current user, from
+        everyone, in one request. '''
+        self.session.receive()
+
+    def show_message(self, conversation, sender, plain_text, cipher_text):
+        ''' Prints a message the session has decrypted and adds it to the history. Called from the session's worker
+        threads. '''
+        name = sender
+        if conversation.peer != sender:
+            # Group messages also say which member sent them.
+            name = "%s %s" % (conversation.peer, sender)
+
+        # Only the cipher text is kept. The plain text is worked out again if the message is looked at.
+        self.history.add(name, cipher_text, conversation.key)
+        with self.output_lock:
+            print "%s: %s" % (name, plain_text)
+
+    def show_trace(self):
+        ''' Displays the latency of every stage of delivery for the traced messages received so far. '''
+        lines = self.session.tracer.summary()
+        for x in lines:
+            print x
+        if len(lines) == 0:
+            print "No traced messages yet. Senders trace messages with --trace-sample."
+
+    def save_trace(self):
+        ''' Prompts for a file and writes the trace histograms and the most recent traces to it as JSON. '''
+        path = raw_input("Save as (trace.json): ") or "trace.json"
+        try:
+            self.session.tracer.dump(path)
+        except (EnvironmentError, ValueError):
+            print "Could not write %s." % path
+            return
+        print "Saved %s." % path
 
     def display_messages(self):
         ''' Displays all of the messages along with the sender, the message number, the plain text and cipher text '''
         print '\n'
-        for (i, val) in enumerate(self.messages):
+        for (i, val) in enumerate(self.history):
             print "Message number: " + str(i)
-            print "Sender: " + val['sender']
-            print "Cipher text: " + val['cipher_text']
-            print "Plain  text: " + val['plain_text'] + "\n"
+            print "Sender: " + val.sender
+            print "Cipher text: " + val.cipher_text
+            print "Plain  text: " + self.history.plain_text(val) + "\n"
 
-        if len(self.messages) == 0:
+        if len(self.history) == 0:
             print "No messages to display."
 
     def decrypt_message(self):
@@ -120,13 +235,48 @@ class Client():
         key = raw_input("Enter the secret key: ")
 
         try:
-            message = self.messages[message_no]
-            cipher = Enigma(message['cipher_text'], key, False)
-            self.messages[message_no]['plain_text'] = cipher.plain_text
+            print self.history.decrypt(message_no, key)
+        except IndexError:
+            print "That message does not exist."
 
-            print cipher.plain_text
+    def search_key(self):
+        ''' Tries a wordlist file or a comma separated list of keys against a message that was sent with the wrong
+        key. If part of the message is known, only keys that decrypt to it are accepted. '''
+        while True:
+            try:
+                message_no = int(raw_input("Enter the message number: "))
+                break
+            except ValueError:
+                print "Please enter a number."
+
+        try:
+            message = self.history.get(message_no)
         except IndexError:
             print "That message does not exist."
+            return
+
+        keys = raw_input("Enter a wordlist file or a comma separated list of keys: ")
+        if os.path.isfile(keys):
+            candidates = load_candidates(keys)
+        else:
+            candidates = [x for x in keys.split(',') if x]
+        crib = raw_input("Enter any text you know is in the message (optional): ")
+
+        search = KeySearch(message.cipher_text, crib)
+        results = search.run(candidates)
+        print "Tried %d keys in %.2f seconds (%.0f keys/second)." % (search.tested, search.elapsed,
+                                                                      search.keys_per_second())
+
+        if len(results) == 0:
+            print "No key matched."
+            return
+
+        for (score, key, plain_text) in results:
+            print "%.2f %s: %s" % (score, key, plain_text)
+
+        key = results[0][1]
+        print "Best key: %s" % key
+        print self.history.decrypt(message_no, key)
 
     def show_commands(self):
         ''' Displays a list of all the commands that the client includes. '''
@@ -136,34 +286,204 @@ class Client():
         print "+-----------------------------------------------------------------------------------+"
 
     def change_key(self):
-        ''' Prompts the user to change the current conversation key '''
-        self.key = raw_input('Enter a new conversation key: ')
+        ''' Prompts the user to change the key for the current conversation '''
+        self.key = self.session.conversation(self.dest_user, raw_input('Enter a new conversation key: ')).key
+        self.history.forget_plain_text()
+
+    def talk_to(self, dest_user, key=None):
+        ''' Makes dest_user the person or group messages are sent to. Someone you have talked to before keeps their
+        key unless a new one is given. '''
+        self.dest_user = dest_user
+        self.key = self.session.conversation(dest_user, key).key
 
     def chat_history(self):
         ''' Displays all the messages that have been recieved this session '''
-        for x in self.messages:
-            print "%s: %s" % (x['sender'], x['plain_text'])
+        for x in self.history:
+            print "%s: %s" % (x.sender, self.history.plain_text(x))
 
     def change_recipient(self):
         ''' Change the username of the person you are talking to '''
-        self.change_key(self)
-        self.dest_user = raw_input('Enter the username of the person you want to talk to: ')
+        dest_user = raw_input('Enter the username of the person you want to talk to: ')
+        if self.session.has_conversation(dest_user):
+            key = raw_input('Enter the conversation key (leave empty to keep the one you used before): ')
+        else:
+            key = raw_input('Enter the conversation key: ')
+        self.talk_to(dest_user, key or None)
+        if self.dest_user.startswith(GROUP_PREFIX):
+            self.join(self.dest_user)
 
         print "You are now messaging: " + self.dest_user
 
+    def list_conversations(self):
+        ''' Lists everyone you have talked to or heard from this session. '''
+        for x in sorted(self.session.conversations):
+            print x + (" (current)" if x == self.dest_user else "")
+
+    def join(self, group):
+        ''' Joins a group so that its messages are delivered to you. '''
+        if self.send("%s\n%s\n%s" % ("group_join", group, self.user)) != "100":
+            print "Could not join %s." % group
+
+    def join_group(self):
+        ''' Prompts for a group to join and starts talking to it. '''
+        group = raw_input('Enter the name of the group, starting with %s: ' % GROUP_PREFIX)
+        if not group.startswith(GROUP_PREFIX):
+            print "Group names start with %s." % GROUP_PREFIX
+            return
+        self.join(group)
+        self.talk_to(group)
+        print "You are now messaging: " + self.dest_user
+
+    def leave_group(self):
+        ''' Prompts for a group to leave. '''
+        group = raw_input('Enter the name of the group to leave: ')
+        if self.send("%s\n%s\n%s" % ("group_leave", group, self.user)) == "100":
+            print "You left %s." % group
+        else:
+            print "You are not in %s." % group
+
+    def group_members(self):
+        ''' Lists the members of the group you are talking to. '''
+        response = self.send("%s\n%s" % ("group_members", self.dest_user)).split('\n')
+        if response[0] == "200":
+            print "Members of %s: %s" % (self.dest_user, ", ".join(response[1:-1]))
+        else:
+            print "%s is not a group with any members." % self.dest_user
+
+    def send_file(self):
+        ''' Prompts for a file and sends it to the current destination user. '''
+        if self.dest_user.startswith(GROUP_PREFIX):
+            print "Files can only be sent to one person."
+            return
+
+        path = raw_input('Enter the path of the file to send: ')
+        try:
+            source = open(path, 'rb')
+        except IOError:
+            print "Could not open %s." % path
+            return
+
+        started = time.time()
+        with source:
+            size = os.fstat(source.fileno()).st_size
+            sent = self.upload(source, size, os.path.basename(path), self.dest_user)
+        if not sent:
+            print "Could not send %s." % path
+            return
+
+        elapsed = max(time.time() - started, 0.001)
+        print "Sent %d bytes in %.2f seconds (%.1f MB/s)." % (size, elapsed, size / elapsed / 1024 / 1024)
+        self.send_message("I sent you a file, %s. Type /files to see it." % os.path.basename(path))
+
+    def upload(self, source, size, name, dest_user):
+        ''' Encrypts a file in byte mode and streams it to the server a chunk at a time, so only one chunk is ever
+        in memory. The file name is encrypted like a message, with the key of the conversation with dest_user.
+        Returns whether the whole file was stored. '''
+        key = self.session.conversation(dest_user).key
+        name = Enigma(name, key, True).cipher_text or Enigma("file", key, True).cipher_text
+        response = self.send("%s\n%s\n%s\n%s\n%d" % ("file_send", dest_user, self.user, name, size)).split('\n')
+        if response[0] != "100":
+            return False
+
+        file_id = response[1]
+        for chunk in stream_file(source, key, True, FILE_CHUNK, binary=True):
+            if self.send("%s\n%s\n%s\n%s" % ("file_chunk", dest_user, file_id, chunk)) != "100":
+                return False
+        return self.send("%s\n%s\n%s" % ("file_end", dest_user, file_id)) == "100"
+
+    def files(self):
+        ''' Returns the files waiting for the current user as (id, sender, file name, size). Each name is decrypted
+        with the key of the conversation with its sender. '''
+        response = self.send("%s\n%s" % ("file_list", self.user)).split('\n')
+        if response[0] != "200":
+            return []
+
+        files = []
+        for x in response[1:-1]:
+            try:
+                (file_id, sender, name, size) = x.split('\t', 3)
+                size = int(size)
+            except ValueError:
+                continue
+            key = self.session.conversation(sender).key
+            files.append((file_id, sender, Enigma(name, key, False).plain_text, size))
+        return files
+
+    def list_files(self):
+        ''' Displays the files that are waiting to be downloaded. '''
+        files = self.files()
+        for (file_id, sender, name, size) in files:
+            print "File %s from %s: %s (%d bytes)" % (file_id, sender, name, size)
+        if len(files) == 0:
+            print "No files waiting."
+
+    def get_file(self):
+        ''' Prompts for a file to download and where to save it. '''
+        files = dict((x[0], x) for x in self.files())
+        file_id = raw_input("Enter the file number: ")
+        if file_id not in files:
+            print "That file does not exist."
+            return
+
+        name = safe_file_name(files[file_id][2])
+        if name is None:
+            path = raw_input("Save as: ")
+        else:
+            path = raw_input("Save as (%s): " % name) or name
+        if path == "":
+            print "The file needs a name to be saved as."
+            return
+        if os.path.exists(path):
+            print "%s already exists." % path
+            return
+
+        with open(path, 'wb') as target:
+            received = self.download(file_id, target, files[file_id][1])
+        if received:
+            print "Saved %s." % path
+        else:
+            print "Could not download the file."
+
+    def download(self, file_id, target, sender):
+        ''' Downloads a file, decrypting each chunk into target as it arrives with the key of the conversation with
+        the sender. The server deletes the file once it has been sent. Returns whether the whole file came
+        through. '''
+        conn = FramedConnection(self.ip, self.port)
+        try:
+            request_id = conn.send_request("%s\n%s\n%s" % ("file_get", self.user, file_id))
+            stream = EnigmaStream(self.session.conversation(sender).key, False, True)
+            remaining = None
+            while remaining is None or remaining > 0:
+                (response_id, response) = conn.read_frame()
+                if response_id != request_id:
+                    continue
+                if remaining is None:
+                    response = response.split('\n')
+                    if response[0] != "200":
+                        return False
+                    remaining = int(response[1])
+                else:
+                    target.write(stream.update(response))
+                    remaining -= len(response)
+            return True
+        except (socket.error, ProtocolError):
+            return False
+        finally:
+            conn.close()
+
+    def close(self):
+        ''' Closes the connection to the server. '''
+        self.active = False
+        self.session.close()
+        self.history.close()
+
     def exit(self):
         ''' Exits the program. '''
-        self.active = False
+        self.close()
         print 'Goodbye!'
 
         sys.exit(0)
 
-    def ping(self):
-        ''' Periodically pings the server to recieve messages from it. '''
-        while self.active:
-            self.get_messages()
-            time.sleep(5)
-
     def check_messages(self):
         ''' Checks to see if any new messages have come in from any other users. '''
         response = self.send('%s\n%s' % ('check', self.user))
@@ -181,13 +501,26 @@ class Client():
             print "Error"
 
 def main():
+    parser = argparse.ArgumentParser(description="Chats over the enigma relay.")
+    parser.add_argument("shards", nargs="?", help="Talk to every shard of a sharded relay directly, as "
+                                                  "host:port,host:port...")
+    parser.add_argument("--spill-dir", help="Directory to move old messages to instead of keeping them in memory.")
+    parser.add_argument("--trace-sample", type=float, default=0.0,
+                        help="Fraction of sent messages to trace on their way to the recipient, from 0 to 1.")
+    args = parser.parse_args()
+
     user = raw_input('Enter your username: ')
     dest_user = raw_input('Enter the name of the user you would like to talk to: ')
     key = raw_input('Enter conversation key: ')
-    client = Client(user, key, dest_user, ip="127.0.0.1")
 
-    # Starts pinging the server ever few seconds for a new message
-    Thread(target = client.ping).start()
+    shards = parse_shards(args.shards) if args.shards else None
+    client = Client(user, key, dest_user, ip="127.0.0.1", shards=shards, spill_dir=args.spill_dir,
+                    trace_sample=args.trace_sample)
+    if dest_user.startswith(GROUP_PREFIX):
+        client.join(dest_user)
+
+    # Starts listening for messages the server pushes to us
+    client.session.start()
     print "You are now talking to %s. Type a message or '/help' for a list of options." % client.dest_user
 
     while True:
@@ -204,4 +537,5 @@ def main():
             pass
         else: client.send_message(command)
 
-main()
+if __name__ == '__main__':
+    main()
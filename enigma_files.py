@@ -0,0 +1,212 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Holds the encrypted files the relay server is waiting to deliver. Files are written to disk a chunk at a
+#          time as they are uploaded and handed back as a memory map when they are downloaded, so the server never
+#          holds a whole file in memory.
+#
+######################################################################
+
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+# Biggest file that can be sent through the server, in bytes.
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+
+# Most bytes of files, uploaded or still uploading, that can be waiting for one recipient.
+RECIPIENT_FILE_BYTES = 2 * 1024 * 1024 * 1024
+
+# Most bytes of files, uploaded or still uploading, the whole spool holds on to.
+SPOOL_BYTES = 10 * 1024 * 1024 * 1024
+
+class SpooledFile():
+    ''' A file being uploaded or waiting to be downloaded. '''
+    __slots__ = ('id', 'recipient', 'sender', 'name', 'size', 'written', 'path', 'file', 'updated')
+
+    def __init__(self, file_id, recipient, sender, name, size, path):
+        self.id = file_id
+        self.recipient = recipient
+        self.sender = sender
+        self.name = name
+        self.size = size
+        self.written = 0
+        self.path = path
+        self.file = open(path, "wb")
+        self.updated = time.time()
+
+class FileSpool():
+    ''' Stores uploaded files in a directory until their recipient downloads them. Without a directory, a temporary
+    one is made and removed again by close(). Space for a file is set aside when its upload starts, at the size it
+    says it will be, so uploads that are still going count towards the limits as well. '''
+    def __init__(self, directory=None, max_file_size=MAX_FILE_SIZE, ttl=None, recipient_bytes=RECIPIENT_FILE_BYTES,
+                 spool_bytes=SPOOL_BYTES):
+        self.temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="enigma-spool-")
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.recipient_bytes = recipient_bytes
+        self.spool_bytes = spool_bytes
+        self.ttl = ttl
+        self.next_id = 1
+        self.size = 0
+
+        # recipient: bytes set aside for their files
+        self.reserved = {}
+
+        # file id: SpooledFile, for uploads that haven't finished yet
+        self.uploads = {}
+
+        # recipient: {file id: SpooledFile}, oldest first
+        self.files = {}
+
+    def start(self, recipient, sender, name, size):
+        ''' Begins an upload and returns its file id, or None if the file is too big or there is no room left for
+        it. '''
+        if (size < 0 or size > self.max_file_size or self.reserved.get(recipient, 0) + size > self.recipient_bytes or
+                self.size + size > self.spool_bytes):
+            return None
+        self.reserved[recipient] = self.reserved.get(recipient, 0) + size
+        self.size += size
+        file_id = self.next_id
+        self.next_id += 1
+        path = os.path.join(self.directory, "%d-%d.part" % (os.getpid(), file_id))
+        self.uploads[file_id] = SpooledFile(file_id, recipient, sender, name, size, path)
+        return file_id
+
+    def write(self, recipient, file_id, data):
+        ''' Appends a chunk to an upload. data can be a buffer so the chunk isn't copied out of the request.
+        Returns False if there is no such upload or the chunk would make the file bigger than it said it was. '''
+        spooled = self.uploads.get(file_id)
+        if spooled is None or spooled.recipient != recipient or spooled.written + len(data) > spooled.size:
+            return False
+        spooled.file.write(data)
+        spooled.written += len(data)
+        spooled.updated = time.time()
+        return True
+
+    def finish(self, recipient, file_id):
+        ''' Makes a fully uploaded file available to its recipient. Returns False if the upload is missing or short,
+        in which case it is thrown away. '''
+        spooled = self.uploads.get(file_id)
+        if spooled is None or spooled.recipient != recipient:
+            return False
+        del self.uploads[file_id]
+        spooled.file.close()
+        spooled.file = None
+        if spooled.written != spooled.size:
+            os.remove(spooled.path)
+            self.release(spooled)
+            return False
+        spooled.updated = time.time()
+        self.files.setdefault(recipient, OrderedDict())[file_id] = spooled
+        return True
+
+    def waiting(self, recipient):
+        ''' Returns the files waiting for a recipient, oldest first. '''
+        return list(self.files.get(recipient, {}).values())
+
+    def remove(self, recipient, file_id):
+        ''' Takes a file out of the spool without deleting it from disk. Returns None if there is no such file. '''
+        spooled = self.files.get(recipient, {}).pop(file_id, None)
+        if spooled is not None:
+            self.release(spooled)
+            if not self.files[recipient]:
+                del self.files[recipient]
+        return spooled
+
+    def release(self, spooled):
+        ''' Gives back the space set aside for a file that has left the spool. '''
+        self.size -= spooled.size
+        left = self.reserved.pop(spooled.recipient, 0) - spooled.size
+        if left > 0:
+            self.reserved[spooled.recipient] = left
+
+    def take(self, recipient, file_id):
+        ''' Removes a file from the spool and returns (SpooledFile, data), where data is a read only memory map of
+        the file, or "" for an empty file. The file is deleted from disk straight away; the map keeps its contents
+        around until the last reference to it goes. Returns None if there is no such file. '''
+        spooled = self.remove(recipient, file_id)
+        if spooled is None:
+            return None
+
+        data = ""
+        with open(spooled.path, "rb") as f:
+            if spooled.size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        os.remove(spooled.path)
+        return spooled, data
+
+    def expire(self, now, idle):
+        ''' Drops uploads that haven't had a chunk for idle seconds and files that have waited longer than the time
+        to live. '''
+        for spooled in [x for x in self.uploads.values() if x.updated <= now - idle]:
+            del self.uploads[spooled.id]
+            spooled.file.close()
+            os.remove(spooled.path)
+            self.release(spooled)
+
+        if self.ttl is None:
+            return
+        for recipient in list(self.files):
+            for spooled in [x for x in self.files[recipient].values() if x.updated <= now - self.ttl]:
+                self.remove(recipient, spooled.id)
+                os.remove(spooled.path)
+
+    def close(self):
+        ''' Throws away every spooled file. '''
+        for spooled in self.uploads.values():
+            spooled.file.close()
+            os.remove(spooled.path)
+        self.uploads = {}
+        for recipient in list(self.files):
+            for spooled in self.files[recipient].values():
+                os.remove(spooled.path)
+        self.files = {}
+        self.reserved = {}
+        self.size = 0
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+def test():
+    from enigma import testit
+    spool = FileSpool(max_file_size=100, recipient_bytes=150, spool_bytes=250)
+    try:
+        # Files go up in chunks and come back whole, and no more than was promised can be written.
+        first = spool.start("bob", "alice", "name", 10)
+        testit(spool.write("bob", first, "01234") and spool.write("bob", first, buffer("x56789", 1)))
+        testit(not spool.write("bob", first, "!") and not spool.write("carol", first, ""))
+        testit(spool.finish("bob", first) and [x.id for x in spool.waiting("bob")] == [first])
+        (spooled, data) = spool.take("bob", first)
+        testit(data[:] == "0123456789" and spooled.sender == "alice" and spool.waiting("bob") == [])
+        testit(spool.take("bob", first) is None)
+
+        # Space is set aside as soon as an upload starts, for each recipient and for the whole spool.
+        testit(spool.start("bob", "alice", "name", 101) is None)
+        second = spool.start("bob", "alice", "name", 100)
+        testit(spool.start("bob", "alice", "name", 51) is None)
+        third = spool.start("bob", "carol", "name", 50)
+        testit(spool.start("carol", "alice", "name", 100) is not None)
+        testit(spool.start("dave", "alice", "name", 1) is None and spool.size == 250)
+
+        # A short upload is thrown away and its space given back.
+        spool.write("bob", second, "too short")
+        testit(not spool.finish("bob", second) and spool.size == 150)
+        testit(spool.start("bob", "alice", "empty", 0) is not None)
+
+        # So is an upload that stops getting chunks.
+        spool.expire(time.time() + 1, 0)
+        testit(spool.uploads == {} and spool.size == 0 and spool.reserved == {})
+        testit(spool.start("bob", "alice", "name", 100) is not None)
+        testit(third not in spool.uploads and os.listdir(spool.directory) != [])
+    finally:
+        spool.close()
+    testit(not os.path.exists(spool.directory))
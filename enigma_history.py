@@ -0,0 +1,128 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Keeps the messages a chat client has received. Only the cipher text is kept, and the plain text is worked
+#          out the first time a message is looked at, so a client that runs for days doesn't keep two copies of
+#          everything. Old messages can be moved to a temporary file so memory use stops growing.
+#
+######################################################################
+
+import tempfile
+import threading
+from array import array
+from enigma import clean_text, compile_key
+
+# How many messages are kept in memory before the oldest are moved to disk, when there is somewhere to put them.
+RESIDENT_MESSAGES = 1000
+
+class HistoryRecord():
+    ''' One received message. key is the number of the key it is decrypted with and plain_text is the plain text for
+    that key, or None until somebody looks at it. '''
+    __slots__ = ('sender', 'cipher_text', 'key', 'plain_text')
+
+    def __init__(self, sender, cipher_text, key):
+        self.sender = sender
+        self.cipher_text = cipher_text
+        self.key = key
+        self.plain_text = None
+
+class History():
+    ''' Every message received this session, numbered from 0 in the order they came in.
+
+    Keys are kept in a list and each message only stores the number of its key, so neither the keys nor the plain
+    text ever end up on disk. Given a spill_dir, messages past the newest resident ones are written to an unnamed
+    temporary file there, which goes away with the client. '''
+    def __init__(self, resident=RESIDENT_MESSAGES, spill_dir=None):
+        self.resident = resident
+        self.keys = []
+        self.key_numbers = {}
+        self.records = []
+
+        # Messages before this number are in the spill file, at the offsets in spilled.
+        self.first_resident = 0
+        self.spilled = array('L')
+        self.spill = tempfile.TemporaryFile(dir=spill_dir) if spill_dir is not None else None
+
+        # Keys picked with /decrypt for messages that are on disk, by message number.
+        self.overrides = {}
+
+        # Messages arrive on the listener thread while the user looks through them on another.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.first_resident + len(self.records)
+
+    def key_number(self, key):
+        number = self.key_numbers.get(key)
+        if number is None:
+            number = self.key_numbers[key] = len(self.keys)
+            self.keys.append(key)
+        return number
+
+    def add(self, sender, cipher_text, key):
+        ''' Stores a received message along with the key it should be decrypted with. '''
+        with self.lock:
+            self.records.append(HistoryRecord(intern(sender), clean_text(cipher_text), self.key_number(key)))
+            if self.spill is not None and len(self.records) > 2 * self.resident:
+                self.spill_oldest(len(self.records) - self.resident)
+
+    def spill_oldest(self, count):
+        ''' Appends the oldest count resident messages to the spill file and lets go of them. '''
+        self.spill.seek(0, 2)
+        for record in self.records[:count]:
+            self.spilled.append(self.spill.tell())
+            self.spill.write("%d\t%s\t%s\n" % (record.key, record.sender, record.cipher_text))
+        del self.records[:count]
+        self.first_resident += count
+
+    def load(self, number):
+        ''' Reads a message back from the spill file. Its plain text isn't kept afterwards. '''
+        self.spill.seek(self.spilled[number])
+        (key, sender, cipher_text) = self.spill.readline()[:-1].split("\t", 2)
+        return HistoryRecord(sender, cipher_text, self.overrides.get(number, int(key)))
+
+    def get(self, number):
+        ''' Returns message number number. Raises IndexError if there is no such message. '''
+        with self.lock:
+            if number < 0 or number >= len(self):
+                raise IndexError(number)
+            if number < self.first_resident:
+                return self.load(number)
+            return self.records[number - self.first_resident]
+
+    def __iter__(self):
+        with self.lock:
+            (spilled, records) = (self.first_resident, list(self.records))
+        for x in range(spilled):
+            with self.lock:
+                record = self.load(x)
+            yield record
+        for record in records:
+            yield record
+
+    def plain_text(self, record):
+        ''' Decrypts a message the first time it's needed and remembers the result for as long as its key stays the
+        same. '''
+        if record.plain_text is None:
+            record.plain_text = compile_key(self.keys[record.key]).decrypt(record.cipher_text)
+        return record.plain_text
+
+    def decrypt(self, number, key):
+        ''' Decrypts a message with a different key and keeps using that key for it. Returns the plain text. '''
+        record = self.get(number)
+        record.key = self.key_number(key)
+        record.plain_text = None
+        if number < self.first_resident:
+            self.overrides[number] = record.key
+        return self.plain_text(record)
+
+    def forget_plain_text(self):
+        ''' Drops every remembered plain text. They are worked out again the next time they're looked at. '''
+        for record in self.records:
+            record.plain_text = None
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
@@ -0,0 +1,134 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Recovers messages that were sent with a mistyped key by trying a list of candidate keys against the
+#          cipher text on every core.
+#
+######################################################################
+
+import multiprocessing
+import string
+import time
+from enigma import EnigmaKey, clean_text
+
+# How many characters of the cipher text each candidate key decrypts.
+PREFIX_LENGTH = 64
+
+# How many candidate keys a worker process is given at a time.
+BATCH_SIZE = 500
+
+# How many of the best scoring keys a search reports.
+RESULT_COUNT = 5
+
+# Characters that show up a lot in english messages. Used to score keys when there is no known plain text.
+_english_characters = string.ascii_letters + " .,'!?"
+_other_characters = "".join(chr(x) for x in range(256) if chr(x) not in _english_characters)
+_common_words = [" the ", " and ", " to ", " of ", " you ", " is ", " it ", " in ", " that ", " i "]
+
+def load_candidates(path):
+    ''' Reads candidate keys from a wordlist file with one key per line. '''
+    with open(path) as wordlist:
+        for line in wordlist:
+            key = line.rstrip("\r\n")
+            if key:
+                yield key
+
+def english_score(text):
+    ''' Scores how much a piece of text looks like english on a scale of roughly 0 to 1. '''
+    if not text:
+        return 0.0
+    letters = len(text.translate(None, _other_characters))
+    padded = " %s " % text.lower()
+    words = sum(padded.count(x) for x in _common_words)
+    return float(letters) / len(text) + 0.1 * words
+
+def score_batch(job):
+    ''' Tries a batch of keys inside a worker process. job is a (cipher prefix, crib, keys) tuple. Returns how many
+    keys were tried along with the (score, key, plain text) of every key that matched the crib, or the best few keys
+    if there is no crib. '''
+    (prefix, crib, keys) = job
+    results = []
+
+    for key in keys:
+        # Keys are only tried once, so they are built directly instead of filling up the compile_key() cache.
+        # The rotor tables themselves are shared by every key in the process.
+        plain_text = EnigmaKey(key).decrypt_python(prefix)
+        if crib is not None:
+            if crib in plain_text:
+                results.append((1.0, key, plain_text))
+        else:
+            results.append((english_score(plain_text), key, plain_text))
+
+    results.sort(reverse=True)
+    return len(keys), results[:RESULT_COUNT]
+
+def batches(candidates, size):
+    ''' Groups an iterable of candidate keys into lists of at most size keys. '''
+    batch = []
+    for key in candidates:
+        batch.append(key)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class KeySearch():
+    ''' Tries a list of candidate keys against a cipher text across a pool of worker processes. If part of the plain
+    text is known (a crib), a key only matches when the crib shows up in its decrypted prefix and the search stops at
+    the first match. Otherwise every key is scored on how much its output looks like english and the best ones are
+    reported. '''
+    def __init__(self, cipher_text, crib=None, prefix_length=PREFIX_LENGTH, processes=None, batch_size=BATCH_SIZE):
+        self.cipher_text = clean_text(cipher_text)
+        self.crib = crib or None
+        if self.crib is not None:
+            prefix_length = max(prefix_length, len(self.crib))
+        self.prefix = self.cipher_text[:prefix_length]
+        self.processes = processes
+        self.batch_size = batch_size
+
+        self.results = []
+        self.tested = 0
+        self.elapsed = 0.0
+
+    def keys_per_second(self):
+        ''' Returns how many keys the last search got through per second. '''
+        if self.elapsed == 0:
+            return 0.0
+        return self.tested / self.elapsed
+
+    def run(self, candidates):
+        ''' Searches an iterable of candidate keys and returns the best (score, key, plain text) results. '''
+        self.results = []
+        self.tested = 0
+        start = time.time()
+
+        jobs = ((self.prefix, self.crib, x) for x in batches(candidates, self.batch_size))
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for (tested, results) in pool.imap_unordered(score_batch, jobs):
+                self.tested += tested
+                self.results.extend(results)
+                self.results.sort(reverse=True)
+                del self.results[RESULT_COUNT:]
+
+                # With a crib any match is the answer, so there is no point trying the rest of the keys.
+                if self.crib is not None and self.results:
+                    pool.terminate()
+                    break
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        self.elapsed = time.time() - start
+        return self.results
+
+    def decrypt(self, key):
+        ''' Decrypts the whole cipher text with a key the search found. '''
+        return EnigmaKey(key).decrypt(self.cipher_text)
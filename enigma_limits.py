@@ -0,0 +1,53 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Rate limits for the relay server, so that one user sending as fast as they can doesn't slow the server
+#          down for everybody else.
+#
+######################################################################
+
+import time
+
+# Messages a user can send per second, on average.
+RATE_LIMIT = 50
+
+# Messages a user can send in one go after being quiet for a while.
+RATE_BURST = 200
+
+class RateLimiter():
+    ''' A token bucket for every user. Each bucket holds up to burst tokens and gains rate tokens a second, and every
+    message costs one. Users that have been quiet long enough for their bucket to fill up again are forgotten by
+    prune(), so only recently active users take up memory. '''
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        # user: [tokens, time the tokens were last topped up]
+        self.buckets = {}
+
+    def allow(self, user, cost=1, now=None):
+        ''' Takes cost tokens from a user's bucket. Returns False, taking nothing, if there aren't enough. '''
+        if now is None:
+            now = time.time()
+
+        bucket = self.buckets.get(user)
+        if bucket is None:
+            bucket = self.buckets[user] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
+
+    def prune(self, now=None):
+        ''' Forgets every user whose bucket would be full by now. '''
+        if now is None:
+            now = time.time()
+        full = [x for (x, y) in self.buckets.iteritems() if y[0] + (now - y[1]) * self.rate >= self.burst]
+        for x in full:
+            del self.buckets[x]
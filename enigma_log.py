@@ -0,0 +1,345 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Keeps a copy of every undelivered message on disk so the relay server can be restarted without losing
+#          anyone's mail.
+#
+# Messages are appended to a log that is split into numbered segment files. When a message is delivered (or
+# expires) a small tombstone with its id is appended instead of changing the old record. Writes are collected and
+# flushed once per trip around the server's event loop, and a background thread calls fsync on a timer, so sending a
+# message never waits on the disk. On startup every segment is read through mmap and the mailboxes are rebuilt from
+# the messages that don't have a tombstone. Once every message in the oldest segment has been delivered the segment
+# is deleted, and an old segment with only a few messages left has them copied forward so it can be deleted too.
+#
+######################################################################
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+# Record types
+MESSAGE = 1
+TOMBSTONE = 2
+
+# type, message id, time stored, recipient length, sender length, payload length
+MESSAGE_HEADER = struct.Struct('!BQdHHI')
+
+# type, message id
+TOMBSTONE_RECORD = struct.Struct('!BQ')
+
+# A new segment is started once the current one is bigger than this.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Seconds between calls to fsync.
+FSYNC_INTERVAL = 0.2
+
+# The oldest segment has its remaining messages copied forward once fewer than this fraction of them are undelivered.
+COMPACT_RATIO = 0.1
+
+class Segment():
+    ''' One file of the log, along with the ids of the messages in it that are still waiting to be delivered. '''
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.live = set()
+        self.total = 0
+        self.written = 0
+
+def segment_name(number):
+    return "segment-%08d.log" % number
+
+class MessageLog():
+    ''' An append-only log of stored messages and delivery tombstones. Attach it to a MailboxStore as its journal
+    after calling recover(). '''
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, fsync_interval=FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Oldest first. The last one is the one being written to.
+        self.segments = []
+
+        # message id: (Segment holding the message, recipient, sender)
+        self.locations = {}
+
+        self.pending = []
+        self.file = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.retired = []
+
+        # Finished segment files the background thread still has to sync and close.
+        self.closing = []
+        self.running = False
+        self.syncer = None
+
+    def recover(self, store, now=None):
+        ''' Reads every segment and puts the undelivered messages back into the store. Returns how many were
+        restored. Must be called before the log is attached to the store. '''
+        numbers = sorted(int(x[8:16]) for x in os.listdir(self.directory)
+                         if x.startswith("segment-") and x.endswith(".log"))
+
+        # message id: (recipient, sender, payload, time stored, Segment)
+        messages = {}
+        for number in numbers:
+            segment = Segment(number, os.path.join(self.directory, segment_name(number)))
+            self.segments.append(segment)
+            self.read_segment(segment, messages)
+
+        if now is None:
+            now = time.time()
+        restored = 0
+        for message_id in sorted(messages):
+            (recipient, sender, payload, stored, segment) = messages[message_id]
+
+            # Anything that has outlived the time to live is left out. It will still have expired the next time.
+            if store.ttl is not None and stored <= now - store.ttl:
+                continue
+
+            store.restore(recipient, sender, message_id, payload, stored)
+            segment.live.add(message_id)
+            self.locations[message_id] = (segment, recipient, sender)
+            restored += 1
+
+        self.open_segment()
+        return restored
+
+    def read_segment(self, segment, messages):
+        ''' Adds the messages in a segment to messages and removes the ones its tombstones point at. A record cut off
+        by a crash at the end of the file is dropped and the file is truncated to the last whole record. '''
+        size = os.path.getsize(segment.path)
+        segment.written = size
+        if size == 0:
+            return
+
+        with open(segment.path, "r+b") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = 0
+            try:
+                while offset < size:
+                    record_type = ord(data[offset])
+                    if record_type == MESSAGE:
+                        if offset + MESSAGE_HEADER.size > size:
+                            break
+                        (x, message_id, stored, recipient_length, sender_length,
+                         payload_length) = MESSAGE_HEADER.unpack_from(data, offset)
+                        start = offset + MESSAGE_HEADER.size
+                        end = start + recipient_length + sender_length + payload_length
+                        if end > size:
+                            break
+                        recipient = data[start:start + recipient_length]
+                        sender = data[start + recipient_length:start + recipient_length + sender_length]
+                        payload = data[start + recipient_length + sender_length:end]
+                        messages[message_id] = (recipient, sender, payload, stored, segment)
+                        segment.total += 1
+                        offset = end
+                    elif record_type == TOMBSTONE:
+                        if offset + TOMBSTONE_RECORD.size > size:
+                            break
+                        (x, message_id) = TOMBSTONE_RECORD.unpack_from(data, offset)
+                        messages.pop(message_id, None)
+                        offset += TOMBSTONE_RECORD.size
+                    else:
+                        break
+            finally:
+                data.close()
+
+            if offset < size:
+                print "Dropping %d damaged bytes at the end of %s" % (size - offset, segment.path)
+                f.truncate(offset)
+                segment.written = offset
+
+    def open_segment(self):
+        ''' Starts writing to a new segment. '''
+        number = self.segments[-1].number + 1 if self.segments else 1
+        segment = Segment(number, os.path.join(self.directory, segment_name(number)))
+
+        new_file = open(segment.path, "ab")
+        with self.lock:
+            if self.file is not None:
+                self.closing.append(self.file)
+            self.file = new_file
+            self.dirty = False
+        self.segments.append(segment)
+
+    def message_stored(self, message, recipient, sender):
+        ''' Journal hook: queues a record for a newly stored message. '''
+        self.pending.append(MESSAGE_HEADER.pack(MESSAGE, message.id, message.stored, len(recipient), len(sender),
+                                                len(message.payload)))
+        self.pending.append(recipient)
+        self.pending.append(sender)
+        self.pending.append(message.payload)
+
+        segment = self.segments[-1]
+        segment.live.add(message.id)
+        segment.total += 1
+        self.locations[message.id] = (segment, recipient, sender)
+
+    def messages_removed(self, messages):
+        ''' Journal hook: queues tombstones for messages that were delivered or expired. '''
+        for message in messages:
+            self.pending.append(TOMBSTONE_RECORD.pack(TOMBSTONE, message.id))
+            location = self.locations.pop(message.id, None)
+            if location is not None:
+                location[0].live.discard(message.id)
+
+    def flush(self):
+        ''' Writes every queued record to the current segment in one go. The data reaches the disk the next time the
+        background thread calls fsync. '''
+        if not self.pending:
+            return
+
+        data = "".join(self.pending)
+        self.pending = []
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            self.dirty = True
+        self.segments[-1].written += len(data)
+
+        if self.segments[-1].written >= self.segment_size:
+            self.open_segment()
+
+    def compact(self, store):
+        ''' Retires old segments. A segment can only go once every segment before it is gone, since its tombstones
+        may point at messages in those. Fully delivered segments are handed to the background thread to delete. If
+        the oldest segment is mostly delivered, the few messages left in it are copied to the current segment so it
+        can be deleted as well. '''
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if oldest.live and len(oldest.live) <= COMPACT_RATIO * oldest.total:
+                self.copy_forward(store, oldest)
+            if oldest.live:
+                break
+            self.segments.pop(0)
+            with self.lock:
+                self.retired.append(oldest.path)
+
+    def copy_forward(self, store, segment):
+        ''' Writes the undelivered messages of a segment again, with the same ids, at the end of the log. '''
+        for message_id in list(segment.live):
+            (x, recipient, sender) = self.locations[message_id]
+            message = store.find(recipient, sender, message_id)
+            segment.live.discard(message_id)
+            if message is not None:
+                self.message_stored(message, recipient, sender)
+        self.flush()
+
+    def sync(self):
+        ''' Calls fsync on the current segment if anything has been written since the last time, syncs and closes
+        finished segments and deletes retired ones. The lock is only held to pick up what needs doing, so flush() is
+        never kept waiting on the disk. '''
+        with self.lock:
+            # A copy of the descriptor stays usable even if open_segment() closes the file in the meantime.
+            descriptor = os.dup(self.file.fileno()) if self.dirty else None
+            self.dirty = False
+            closing = self.closing
+            self.closing = []
+            retired = self.retired
+            self.retired = []
+
+        for f in closing:
+            os.fsync(f.fileno())
+            f.close()
+        if descriptor is not None:
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+        for path in retired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def run(self):
+        while self.running:
+            time.sleep(self.fsync_interval)
+            self.sync()
+
+    def start(self):
+        ''' Starts the background thread that syncs the log to disk. '''
+        self.running = True
+        self.syncer = threading.Thread(target=self.run)
+        self.syncer.daemon = True
+        self.syncer.start()
+
+    def close(self):
+        ''' Writes out anything queued, syncs it and stops the background thread. '''
+        self.flush()
+        self.running = False
+        if self.syncer is not None:
+            self.syncer.join()
+        self.sync()
+        with self.lock:
+            self.file.close()
+
+def stored_messages(store):
+    ''' Returns every message in a store as sorted (id, recipient, sender, payload) tuples. '''
+    return sorted((x.id, recipient, sender, x.payload) for ((recipient, sender), mailbox) in store.mailboxes.items()
+                  for x in mailbox.messages)
+
+def test():
+    from enigma import testit
+    from enigma_mailbox import MailboxStore
+    directory = tempfile.mkdtemp(prefix="enigma-log-test-")
+    try:
+        # Small segments, so a few hundred messages are spread over lots of them.
+        store = MailboxStore(ttl=None)
+        log = MessageLog(directory, segment_size=2000)
+        testit(log.recover(store) == 0)
+        store.journal = log
+        store.add("bob", "early", "first")
+        for x in range(300):
+            store.add("bob", "sender%d" % (x // 10), "message %d" % x)
+            log.flush()
+        segments = len(log.segments)
+
+        # Delivering everything but the very first message and the newest ones lets compaction copy the first one
+        # forward and retire the old segments.
+        for x in range(25):
+            store.drain("bob", "sender%d" % x)
+        log.flush()
+        log.compact(store)
+        testit(len(log.closing) >= segments - 1)
+        log.sync()
+        testit(not log.closing and not log.file.closed)
+        testit(log.segments[0].number > 1 and len(log.segments) < segments)
+        testit(len(os.listdir(directory)) == len(log.segments))
+        expected = stored_messages(store)
+
+        # Names too long for the log are turned away before anything is stored.
+        testit(not store.add("x" * 70000, "sender", "message"))
+        testit(stored_messages(store) == expected)
+        log.close()
+
+        restored = MailboxStore(ttl=None)
+        log = MessageLog(directory, segment_size=2000)
+        testit(log.recover(restored) == len(expected))
+        testit(stored_messages(restored) == expected)
+        testit(restored.drain("bob", "early")[0].payload == "first")
+        log.close()
+
+        # A record cut off part way through by a crash is dropped and the file is truncated to the records before it.
+        last = os.path.join(directory, sorted(os.listdir(directory))[-1])
+        size = os.path.getsize(last)
+        with open(last, "ab") as f:
+            f.write(MESSAGE_HEADER.pack(MESSAGE, 10000, time.time(), 3, 6, 100) + "bobsender" + "cut off")
+        restored = MailboxStore(ttl=None)
+        log = MessageLog(directory, segment_size=2000)
+        testit(log.recover(restored) == len(expected))
+        testit(stored_messages(restored) == expected)
+        testit(os.path.getsize(last) == size)
+        log.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,271 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Holds the messages the relay server is waiting to deliver.
+#
+######################################################################
+
+import time
+from collections import OrderedDict, deque
+
+# Most messages one sender can leave waiting for one recipient.
+MAILBOX_LIMIT = 1000
+
+# Most bytes of messages one sender can leave waiting for one recipient.
+MAILBOX_BYTES = 1024 * 1024
+
+# Most messages, from everyone together, that can be waiting for one recipient.
+RECIPIENT_LIMIT = 10000
+
+# Most bytes of messages the whole server holds on to.
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+# Seconds an undelivered message is kept before it is thrown away. None keeps messages forever.
+MESSAGE_TTL = 7 * 24 * 60 * 60
+
+# Longest recipient or sender name, in bytes, that a message can have. The message log keeps name lengths in two
+# bytes.
+NAME_LIMIT = 65535
+
+class Message():
+    ''' A single stored message. '''
+    __slots__ = ('id', 'payload', 'stored')
+
+    def __init__(self, message_id, payload, stored):
+        self.id = message_id
+        self.payload = payload
+        self.stored = stored
+
+class Mailbox():
+    ''' The messages one sender has left for one recipient, oldest first. '''
+    __slots__ = ('messages', 'size')
+
+    def __init__(self):
+        self.messages = deque()
+        self.size = 0
+
+class MailboxStore():
+    ''' Stores undelivered messages in one queue per (recipient, sender) pair. Adding a message and draining a mailbox
+    don't depend on how much else is stored, and the number of unread messages for each recipient is kept up to date
+    as messages come and go, so checking for mail never has to look through the queues.
+
+    If a journal is attached, it is told about every message that is stored and every message that leaves the store,
+    through its message_stored(message, recipient, sender) and messages_removed(messages) methods. '''
+    def __init__(self, mailbox_limit=MAILBOX_LIMIT, mailbox_bytes=MAILBOX_BYTES, memory_limit=MEMORY_LIMIT,
+                 ttl=MESSAGE_TTL, recipient_limit=RECIPIENT_LIMIT):
+        self.mailbox_limit = mailbox_limit
+        self.recipient_limit = recipient_limit
+        self.mailbox_bytes = mailbox_bytes
+        self.memory_limit = memory_limit
+        self.ttl = ttl
+        self.journal = None
+        self.next_id = 1
+
+        # (recipient, sender): Mailbox
+        self.mailboxes = {}
+
+        # recipient: {sender: Mailbox}
+        self.recipients = {}
+
+        # recipient: number of unread messages
+        self.unread = {}
+
+        self.size = 0
+        self.count = 0
+
+        # message id: (time stored, recipient, sender) for every stored message, oldest first, so expired ones can be
+        # found quickly. Messages are taken out as soon as they leave the store.
+        self.arrivals = OrderedDict()
+
+    def add(self, recipient, sender, payload):
+        ''' Stores a message. Returns False without storing it if it would go over one of the limits. '''
+        if len(recipient) > NAME_LIMIT or len(sender) > NAME_LIMIT:
+            return False
+
+        mailbox = self.mailboxes.get((recipient, sender))
+        if mailbox is None:
+            mailbox = Mailbox()
+
+        size = len(payload)
+        if (len(mailbox.messages) >= self.mailbox_limit or mailbox.size + size > self.mailbox_bytes or
+                self.unread.get(recipient, 0) >= self.recipient_limit or self.size + size > self.memory_limit):
+            return False
+
+        message = self.insert(recipient, sender, mailbox, Message(self.next_id, payload, time.time()))
+        if self.journal is not None:
+            self.journal.message_stored(message, recipient, sender)
+        return True
+
+    def restore(self, recipient, sender, message_id, payload, stored):
+        ''' Puts back a message that was stored before the server restarted. The limits are not checked and the
+        journal isn't told, since the message is already in it. '''
+        mailbox = self.mailboxes.get((recipient, sender))
+        if mailbox is None:
+            mailbox = Mailbox()
+        self.insert(recipient, sender, mailbox, Message(message_id, payload, stored))
+
+    def insert(self, recipient, sender, mailbox, message):
+        ''' Adds a message to the end of a mailbox and updates the totals. '''
+        if not mailbox.messages:
+            self.mailboxes[(recipient, sender)] = mailbox
+            self.recipients.setdefault(recipient, {})[sender] = mailbox
+
+        size = len(message.payload)
+        mailbox.messages.append(message)
+        mailbox.size += size
+        self.size += size
+        self.count += 1
+        self.next_id = max(self.next_id, message.id + 1)
+        self.unread[recipient] = self.unread.get(recipient, 0) + 1
+        if self.ttl is not None:
+            self.arrivals[message.id] = (message.stored, recipient, sender)
+        return message
+
+    def has(self, recipient, sender):
+        ''' Whether a sender has left any messages for a recipient. '''
+        return (recipient, sender) in self.mailboxes
+
+    def drain(self, recipient, sender, max_bytes=None):
+        ''' Removes and returns every Message a sender has left for a recipient, oldest first. Given max_bytes, only
+        the oldest messages that fit in that many bytes are taken, though always at least one. '''
+        mailbox = self.mailboxes.get((recipient, sender))
+        if mailbox is None:
+            return []
+
+        count = len(mailbox.messages)
+        if max_bytes is not None and mailbox.size > max_bytes:
+            (count, size) = (0, 0)
+            for message in mailbox.messages:
+                size += len(message.payload)
+                if count > 0 and size > max_bytes:
+                    break
+                count += 1
+        return self.remove(recipient, sender, mailbox, count)
+
+    def drain_all(self, recipient, max_bytes=None):
+        ''' Removes every message waiting for a recipient and returns them as (sender, Message) pairs, grouped by
+        sender and oldest first within each sender. Given max_bytes, messages stop being taken once they add up to
+        about that many bytes. '''
+        drained = []
+        for sender in self.senders(recipient):
+            if max_bytes is not None and max_bytes <= 0:
+                break
+            messages = self.drain(recipient, sender, max_bytes)
+            drained.extend((sender, x) for x in messages)
+            if max_bytes is not None:
+                max_bytes -= sum(len(x.payload) for x in messages)
+        return drained
+
+    def find(self, recipient, sender, message_id):
+        ''' Returns the stored message with the given id, or None if it has already left the store. '''
+        mailbox = self.mailboxes.get((recipient, sender))
+        if mailbox is not None:
+            for message in mailbox.messages:
+                if message.id == message_id:
+                    return message
+        return None
+
+    def senders(self, recipient):
+        ''' Returns every user who has left messages for a recipient. '''
+        return list(self.recipients.get(recipient, ()))
+
+    def unread_count(self, recipient):
+        ''' Returns how many messages are waiting for a recipient. '''
+        return self.unread.get(recipient, 0)
+
+    def expire(self, now=None):
+        ''' Throws away every message that has been waiting for longer than the time to live. Returns how many were
+        removed. '''
+        if self.ttl is None:
+            return 0
+
+        if now is None:
+            now = time.time()
+        cutoff = now - self.ttl
+        expired = 0
+
+        while self.arrivals:
+            # The oldest message in the store is always the oldest one in its own mailbox too.
+            (stored, recipient, sender) = self.arrivals[next(iter(self.arrivals))]
+            if stored > cutoff:
+                break
+            self.remove(recipient, sender, self.mailboxes[(recipient, sender)], 1)
+            expired += 1
+
+        return expired
+
+    def remove(self, recipient, sender, mailbox, count):
+        ''' Takes the oldest count messages out of a mailbox, updates the totals and returns the removed messages. '''
+        if count == len(mailbox.messages):
+            removed = list(mailbox.messages)
+            mailbox.messages.clear()
+        else:
+            removed = [mailbox.messages.popleft() for x in range(count)]
+
+        size = sum(len(x.payload) for x in removed)
+        mailbox.size -= size
+        self.size -= size
+        self.count -= count
+
+        if self.ttl is not None:
+            for message in removed:
+                del self.arrivals[message.id]
+
+        self.unread[recipient] -= count
+        if self.unread[recipient] == 0:
+            del self.unread[recipient]
+
+        if not mailbox.messages:
+            del self.mailboxes[(recipient, sender)]
+            del self.recipients[recipient][sender]
+            if not self.recipients[recipient]:
+                del self.recipients[recipient]
+
+        if self.journal is not None:
+            self.journal.messages_removed(removed)
+        return removed
+
+def test():
+    from enigma import testit
+
+    # A mailbox takes a limited number of messages and bytes, and other senders aren't held up by a full one.
+    store = MailboxStore(mailbox_limit=3, mailbox_bytes=10, recipient_limit=5, memory_limit=25)
+    testit(store.add("bob", "alice", "1234") and store.add("bob", "alice", "5678"))
+    testit(not store.add("bob", "alice", "abc"))
+    testit(store.add("bob", "alice", "ab") and not store.add("bob", "alice", "c"))
+    testit(store.add("bob", "carol", "x"))
+
+    # So does a recipient, from all senders together.
+    testit(store.add("bob", "dave", "y") and store.unread_count("bob") == 5)
+    testit(not store.add("bob", "erin", "z") and not store.has("bob", "erin"))
+
+    # And the whole store, across recipients.
+    testit(store.add("carol", "alice", "0123456789") and not store.add("dave", "alice", "0123456789"))
+    testit(store.size == 22 and store.count == 6)
+
+    # Draining takes messages oldest first and gives the space back.
+    testit([x.payload for x in store.drain("bob", "alice")] == ["1234", "5678", "ab"])
+    testit(store.size == 12 and store.unread_count("bob") == 2 and not store.has("bob", "alice"))
+    testit(sorted((s, x.payload) for (s, x) in store.drain_all("bob")) == [("carol", "x"), ("dave", "y")])
+
+    # Messages are thrown away once they have waited longer than the time to live, oldest first.
+    store = MailboxStore(ttl=60)
+    store.restore("bob", "alice", 1, "old", 100.0)
+    store.restore("bob", "carol", 2, "old", 110.0)
+    store.restore("bob", "alice", 3, "new", 150.0)
+    testit(store.expire(150.0) == 0)
+    testit(store.expire(170.0) == 2)
+    testit([x.payload for x in store.drain("bob", "alice")] == ["new"] and store.count == 0)
+    testit(store.expire(1000.0) == 0)
+    testit(store.add("bob", "alice", "next") and store.drain("bob", "alice")[0].id == 4)
+
+    # Nothing is left behind once messages are delivered, however many go through the store.
+    for x in range(10000):
+        store.add("bob", "sender%d" % (x % 100), "message %d" % x)
+        if x % 7 == 0:
+            store.drain_all("bob")
+    store.drain_all("bob")
+    testit(not store.arrivals and not store.mailboxes and not store.recipients and not store.unread)
+    testit(store.size == 0 and store.count == 0)
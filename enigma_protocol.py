@@ -0,0 +1,173 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: The wire format shared by the enigma chat client and server, along with a small pool of long lived
+#          client connections.
+#
+# Every request and response is sent as a frame: a magic byte, a request id and the length of the payload, followed
+# by the payload itself. The payload is the same newline separated command the server has always understood. The
+# request id lets a client match up responses when it sends several requests over one connection.
+#
+######################################################################
+
+import socket
+import struct
+import threading
+from Queue import Queue, Empty
+
+# First byte of every frame. Old clients start with the name of a command, so the server can tell them apart.
+FRAME_MAGIC = '\xe7'
+
+# magic, request id, payload length
+HEADER = struct.Struct('!cII')
+
+# Frames bigger than this are treated as garbage and the connection is dropped.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# How many connections a ConnectionPool keeps open to the server.
+POOL_SIZE = 2
+
+# Names that start with this are groups rather than users.
+GROUP_PREFIX = "#"
+
+class ProtocolError(Exception):
+    ''' Raised when the other side sends something that isn't a valid frame. '''
+    pass
+
+def encode_frame(request_id, payload):
+    ''' Wraps a payload in a frame header. '''
+    return HEADER.pack(FRAME_MAGIC, request_id, len(payload)) + payload
+
+class FrameDecoder():
+    ''' Collects bytes as they arrive off a socket and splits them back into frames. '''
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        ''' Adds newly received data and returns a list of (request id, payload) for every frame it completed. '''
+        self.buffer.extend(data)
+        frames = []
+
+        while len(self.buffer) >= HEADER.size:
+            (magic, request_id, length) = HEADER.unpack_from(self.buffer)
+            if magic != FRAME_MAGIC or length > MAX_FRAME_SIZE:
+                raise ProtocolError("Bad frame header")
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+
+            # Copies the payload out once, rather than slicing the bytearray and then converting the slice.
+            frames.append((request_id, str(buffer(self.buffer, HEADER.size, length))))
+            del self.buffer[:end]
+
+        return frames
+
+def recv_exact(sock, length):
+    ''' Reads exactly length bytes from a blocking socket. '''
+    chunks = []
+    while length > 0:
+        data = sock.recv(min(length, 65536))
+        if not data:
+            raise socket.error("Connection closed by server")
+        chunks.append(data)
+        length -= len(data)
+    return "".join(chunks)
+
+def read_frame(sock):
+    ''' Reads one whole frame from a blocking socket and returns (request id, payload). '''
+    (magic, request_id, length) = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if magic != FRAME_MAGIC or length > MAX_FRAME_SIZE:
+        raise ProtocolError("Bad frame header")
+    return request_id, recv_exact(sock, length)
+
+class FramedConnection():
+    ''' A blocking connection to the server that can carry any number of requests. '''
+    def __init__(self, ip, port, timeout=None):
+        self.sock = socket.create_connection((ip, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.next_id = 0
+        self.send_lock = threading.Lock()
+
+    def new_request_id(self):
+        ''' Reserves a request id, for callers that need to know it before the request is sent. '''
+        with self.send_lock:
+            self.next_id = (self.next_id + 1) % (2 ** 32)
+            return self.next_id
+
+    def send_request(self, payload, request_id=None):
+        ''' Sends a request without waiting for the response and returns its request id. Safe to call while another
+        thread is reading responses off the connection. '''
+        with self.send_lock:
+            if request_id is None:
+                self.next_id = (self.next_id + 1) % (2 ** 32)
+                request_id = self.next_id
+            self.sock.sendall(encode_frame(request_id, payload))
+        return request_id
+
+    def read_frame(self):
+        ''' Waits for the next frame from the server and returns (request id, payload). '''
+        return read_frame(self.sock)
+
+    def request(self, payload):
+        ''' Sends a request and waits for the response with the same request id. '''
+        request_id = self.send_request(payload)
+
+        while True:
+            (response_id, response) = read_frame(self.sock)
+            if response_id == request_id:
+                return response
+
+    def close(self):
+        self.sock.close()
+
+class ConnectionPool():
+    ''' Keeps a few connections to the server open so that requests don't have to pay for a new connection every
+    time. Any number of threads can share one pool. A connection that turns out to have been closed by the server is
+    replaced and the request is tried again. '''
+    def __init__(self, ip, port, size=POOL_SIZE, timeout=None):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.idle = Queue()
+        self.slots = threading.Semaphore(size)
+
+    def request(self, payload):
+        ''' Sends a request over a pooled connection and returns the response payload. '''
+        self.slots.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except Empty:
+                conn = FramedConnection(self.ip, self.port, self.timeout)
+                reused = False
+
+            try:
+                response = conn.request(payload)
+            except (socket.error, ProtocolError):
+                conn.close()
+                if not reused:
+                    raise
+
+                # The connection sat idle long enough for the server to close it, so try once on a fresh one.
+                conn = FramedConnection(self.ip, self.port, self.timeout)
+                try:
+                    response = conn.request(payload)
+                except:
+                    conn.close()
+                    raise
+
+            self.idle.put(conn)
+            return response
+        finally:
+            self.slots.release()
+
+    def close(self):
+        ''' Closes every idle connection. '''
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
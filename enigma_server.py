@@ -10,118 +10,945 @@
 #
 ######################################################################
 
+import argparse
+import asyncore
+import errno
+import json
+import os
+import signal
 import socket
+import time
+from collections import deque
+from enigma_files import MAX_FILE_SIZE, RECIPIENT_FILE_BYTES, SPOOL_BYTES, FileSpool
+from enigma_limits import RATE_BURST, RATE_LIMIT, RateLimiter
+from enigma_log import MessageLog
+from enigma_mailbox import MAILBOX_BYTES, MAILBOX_LIMIT, MEMORY_LIMIT, MESSAGE_TTL, RECIPIENT_LIMIT, MailboxStore
+from enigma_protocol import FRAME_MAGIC, GROUP_PREFIX, HEADER, FrameDecoder, ProtocolError, encode_frame
+from enigma_shard import Forwarder, ShardRing, parse_shards
+from enigma_stats import ServerStats
+from enigma_trace import TRACE_MARK, prepend, relay_stamp
 
-def main():
-    # IP = '104.131.187.248' # Change to 127.0.0.1 to run the server locally.
-    IP = '127.0.0.1'
-    port = 5005
-    buffer = 2048
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# IP = '104.131.187.248' # Pass --ip to run the server somewhere other than locally.
+IP = '127.0.0.1'
+PORT = 5005
+BUFFER = 65536
+
+# Connections that haven't sent or received anything for this many seconds are closed.
+READ_TIMEOUT = 30
+
+# How often, in seconds, the server looks for timed out connections.
+SWEEP_INTERVAL = 1
+
+# Seconds a connection can be idle before TCP keepalive starts checking on the client, seconds between checks, and
+# how many checks can go unanswered before the connection is dropped. Subscribers that vanish without closing their
+# connection are found in about two minutes instead of the usual two hours.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
+# How many connections the kernel queues up while the server is busy accepting others.
+LISTEN_BACKLOG = socket.SOMAXCONN
+
+# Most client connections open at once. Connections past this get the busy response and are closed.
+MAX_CONNECTIONS = 1000
+
+# Seconds a connection that is being turned away has to send its first request before it is simply closed.
+BUSY_TIMEOUT = 2
+
+# Open files kept back from client connections for the listening socket, the message log, spooled files and such.
+RESERVED_FILES = 32
+
+# A connection with this many responses waiting to be written isn't read from until the client catches up.
+OUTPUT_QUEUE_LIMIT = 1024
+
+# Most bytes of messages taken out of the store for one push to a subscriber. The rest wait for the next one.
+PUSH_BYTES = 256 * 1024
+
+# Response sent when the server, or the sender's rate limit, can't take any more right now.
+BUSY = "300"
+
+# Commands that count against the sender's rate limit.
+RATE_LIMITED = ("send", "send_batch", "file_send")
+
+# Longest a poll request is held open, in seconds, when the client doesn't ask for less.
+POLL_TIMEOUT = 25
+
+# Seconds between writes of the stats file, when there is one.
+STATS_INTERVAL = 60
+
+# Commands the server understands. Anything else is counted as an error.
+COMMANDS = ("send", "send_batch", "receive", "receive_all", "check", "subscribe", "poll", "stats", "group_join",
+            "group_leave", "group_members", "names", "file_send", "file_chunk", "file_end", "file_list", "file_get",
+            "forward")
+
+# Size of the frames a downloaded file is sent back in.
+FILE_CHUNK = 256 * 1024
+
+class RelayConnection(asyncore.dispatcher):
+    ''' A single client connection. Clients that speak the framed protocol keep the connection open and send any
+    number of requests over it. Old clients send one bare command, get one response and the connection is closed. '''
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.out_buffer = deque()
+        self.done = False
+        self.last_activity = time.time()
+        self.timeout = server.timeout
 
-    # all_messages = [recipient: {sender: [message1, message2...]}}
-    all_messages = {}
+        # Decided by the first byte the client sends.
+        self.framed = None
+        self.decoder = FrameDecoder()
+        self.request_id = 0
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((IP, port))
+        # (user, sender, request id) of the messages this connection has subscribed to, if any. A sender of None
+        # means messages from everyone.
+        self.subscription = None
+
+        # (user, sender, request id, deadline) of a poll request waiting for a message, if any.
+        self.poll = None
+
+        # Subscribed connections sit idle on purpose, so dead peers are left for TCP keepalive to find. The timings
+        # can't be changed on every system.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for (option, value) in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                                ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                self.socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+        self.open = True
+        server.stats.connection_opened()
+
+    def sendall(self, data):
+        ''' Queues a response to the current request to be written once the socket is ready for it. Named after
+        socket.sendall so the command functions don't care what kind of connection they are answering. '''
+        self.send_response(self.request_id, data)
+
+    def send_response(self, request_id, payload):
+        ''' Queues a response to a request, which doesn't have to be the one currently being handled. '''
+        if payload == "202":
+            self.server.stats.error()
+        if not self.out_buffer:
+            # The client has the read timeout, from now, to start taking the response.
+            self.last_activity = time.time()
+        if self.framed:
+            self.out_buffer.append(encode_frame(request_id, payload))
+        else:
+            self.out_buffer.append(payload)
+
+    def send_file(self, request_id, header, data):
+        ''' Queues a response followed by the contents of a file, split into frames of FILE_CHUNK bytes. The frames
+        are buffers over data, usually a memory map, so the file is never copied into strings on its way out. '''
+        self.send_response(request_id, header)
+        for x in range(0, len(data), FILE_CHUNK):
+            chunk = buffer(data, x, FILE_CHUNK)
+            self.out_buffer.append(HEADER.pack(FRAME_MAGIC, request_id, len(chunk)))
+            self.out_buffer.append(chunk)
+
+    def waiting(self):
+        ''' Whether the connection is idle because it is waiting on the server rather than the other way around. A
+        connection with responses it hasn't taken isn't waiting on the server. '''
+        return (self.subscription is not None or self.poll is not None) and not self.out_buffer
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.server.stats.connection_closed()
+        self.server.forget(self)
+        asyncore.dispatcher.close(self)
+
+    def handle_read(self):
+        data = self.recv(BUFFER)
+        self.last_activity = time.time()
+        if not data:
+            return
+        self.server.stats.bytes_in += len(data)
+
+        if self.framed is None:
+            self.framed = data[0] == FRAME_MAGIC
+
+        if not self.framed:
+            self.server.dispatch(data, self)
+            self.done = True
+            return
+
+        try:
+            frames = self.decoder.feed(data)
+        except ProtocolError:
+            print "Bad frame from client, closing the connection."
+            self.close()
+            return
+
+        for (request_id, payload) in frames:
+            self.request_id = request_id
+            self.server.dispatch(payload, self)
+
+    def readable(self):
+        # Stops reading from clients that send requests faster than they read the responses.
+        return not self.done and len(self.out_buffer) < OUTPUT_QUEUE_LIMIT
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer[0])
+        self.server.stats.bytes_out += sent
+        if sent == len(self.out_buffer[0]):
+            self.out_buffer.popleft()
+        else:
+            # A buffer over the rest avoids copying what is left of a big response every time part of it goes out.
+            self.out_buffer[0] = buffer(self.out_buffer[0], sent)
+        self.last_activity = time.time()
 
-    print "Starting up server. IP: %s. Port: %s" % (IP, port)
+        if self.out_buffer:
+            return
+        if self.done:
+            self.close()
+        elif self.subscription is not None:
+            # Messages that came in while the connection was busy were left in the store until now.
+            self.server.push(self)
 
-    while True:
-        s.listen(5)
+    def handle_close(self):
+        self.close()
 
-        # Waits for new connections.
-        conn, addr = s.accept()
-        m = []
-        data = conn.recv(buffer)
+    def handle_error(self):
+        print "Connection error, closing it."
+        self.close()
 
-        # When connection recieved, message split into new array m
-        m = data.split("\n")
+class BusyConnection(RelayConnection):
+    ''' A connection that arrived while the server was full. Its first request is answered with the busy response,
+    framed or not to match the client, and then it is closed. '''
+    def __init__(self, sock, server):
+        RelayConnection.__init__(self, sock, server)
+        self.timeout = BUSY_TIMEOUT
+
+    def handle_read(self):
+        data = self.recv(BUFFER)
+        if not data:
+            return
+
+        request_id = 0
+        self.framed = data[0] == FRAME_MAGIC
+        if self.framed and len(data) >= HEADER.size:
+            request_id = HEADER.unpack_from(data)[1]
+        self.server.stats.turned_away()
+        self.send_response(request_id, BUSY)
+        self.done = True
+
+class RelayServer(asyncore.dispatcher):
+    ''' Accepts connections and relays messages between them without ever blocking on a single client. '''
+    def __init__(self, ip=IP, port=PORT, timeout=READ_TIMEOUT, store=None, stats_file=None,
+                 stats_interval=STATS_INTERVAL, shards=None, spool=None, limiter=None, max_connections=MAX_CONNECTIONS,
+                 backlog=LISTEN_BACKLOG):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.running = False
+
+        # Senders are held to a rate limit when there is a limiter, and clients past max_connections are turned away.
+        self.limiter = limiter
+        self.max_connections = connection_limit(max_connections)
+
+        # Kept open so that a file can be freed up to turn a connection away when the process runs out of them.
+        self.spare = open(os.devnull)
+
+        self.stats = ServerStats()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.last_dump = time.time()
+
+        # Every undelivered message, kept in a queue per recipient and sender.
+        if store is None:
+            store = MailboxStore()
+        self.store = store
+
+        # Connections waiting for new messages, by recipient.
+        self.subscribers = {}
+        self.pollers = {}
+
+        # group name: set of members
+        self.groups = {}
+
+        # Files waiting to be downloaded, kept on disk.
+        if spool is None:
+            spool = FileSpool(ttl=self.store.ttl)
+        self.spool = spool
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((ip, port))
+        self.listen(backlog)
+
+        # Lets the caller find out which port was picked when port 0 is passed in.
+        self.port = self.socket.getsockname()[1]
+
+        # When the relay is split into shards, group messages for members owned by another shard are passed on to it.
+        self.ring = None
+        self.forwarder = None
+        self.peers = set()
+        if shards is not None:
+            self.ring = ShardRing(shards)
+            self.forwarder = Forwarder()
+            self.peers = shard_hosts(shards)
+
+    def handle_accept(self):
+        # Takes every connection that is waiting rather than one per trip around the event loop.
+        while True:
+            try:
+                pair = self.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EMFILE, errno.ENFILE):
+                    raise
+                self.shed()
+                break
+            if pair is None:
+                break
+
+            # Past twice the limit there isn't even room to say so, and the connection is dropped straight away.
+            if self.stats.connections >= 2 * self.max_connections:
+                pair[0].close()
+                self.stats.turned_away()
+            elif self.stats.connections >= self.max_connections:
+                BusyConnection(pair[0], self)
+            else:
+                RelayConnection(pair[0], self)
+
+    def shed(self):
+        ''' Drops a waiting connection when the process is out of files. The spare file is closed to make room to
+        accept it, otherwise the connection would sit in the queue and keep the listening socket readable. '''
+        self.stats.turned_away()
+        if self.spare is None:
+            return
+        self.spare.close()
+        try:
+            self.socket.accept()[0].close()
+        except socket.error:
+            pass
+        try:
+            self.spare = open(os.devnull)
+        except IOError:
+            self.spare = None
+
+    def handle_error(self):
+        ''' asyncore closes a dispatcher that runs into an error, which for the listening socket would stop the server
+        from ever accepting another connection. '''
+        print "Error accepting a connection."
+
+    def dispatch(self, data, conn):
+        ''' Runs the command in a request and queues the response on the connection. '''
+        started = time.time()
+
+        # When connection recieved, message split into new array m. File chunks are raw bytes after the first three
+        # lines, so only those are split off and the chunk itself is never copied.
+        if data.startswith("file_chunk\n"):
+            (m, start) = chunk_header(data)
+        else:
+            m = data.split("\n")
 
         # m[0] contains the server command (send, check or receive)
-        if m[0] == "send":
-            send(all_messages, m, conn)
+        if not self.admit(m):
+            self.stats.turned_away()
+            conn.sendall(BUSY)
+        elif m[0] == "file_chunk":
+            self.file_chunk(data, start, m, conn)
+        elif m[0] in ("send", "send_batch") and len(m) >= 2 and m[1].startswith(GROUP_PREFIX):
+            self.send_group(m, conn)
+        elif m[0] == "forward":
+            self.forwarded(m, conn)
+        elif m[0] == "send":
+            send(self.store, m, conn)
+            if len(m) >= 4:
+                self.notify(m[1])
+        elif m[0] == "send_batch":
+            send_batch(self.store, m, conn)
+            if len(m) >= 4:
+                self.notify(m[1])
         elif m[0] == "receive":
-            receive(all_messages, m, conn)
+            receive(self.store, m, conn, self.stats)
+        elif m[0] == "receive_all":
+            receive_all(self.store, m, conn, self.stats)
         elif m[0] == "check":
-            check_messages(all_messages,m,conn)
+            check_messages(self.store, m, conn)
+        elif m[0] == "subscribe":
+            self.subscribe(m, conn)
+        elif m[0] == "poll":
+            self.long_poll(m, conn)
+        elif m[0] == "group_join":
+            self.group_join(m, conn)
+        elif m[0] == "group_leave":
+            self.group_leave(m, conn)
+        elif m[0] == "group_members":
+            self.group_members(m, conn)
+        elif m[0] == "file_send":
+            self.file_send(m, conn)
+        elif m[0] == "file_end":
+            conn.sendall("100" if len(m) >= 3 and m[2].isdigit() and self.spool.finish(m[1], int(m[2])) else "101")
+        elif m[0] == "file_list":
+            self.file_list(m, conn)
+        elif m[0] == "file_get":
+            self.file_get(m, conn)
+        elif m[0] == "names":
+            self.names(conn)
+        elif m[0] == "stats":
+            conn.sendall("200\n" + json.dumps(self.stats.snapshot(self.store), sort_keys=True))
         else:
             conn.sendall("202")
-        conn.close()
+
+        if m[0] in COMMANDS:
+            self.stats.record(m[0], time.time() - started)
+
+    def admit(self, m):
+        ''' Whether a request fits in its sender's rate limit. Every message sent costs one token, so a batch bigger
+        than the burst never fits. '''
+        if self.limiter is None or m[0] not in RATE_LIMITED or len(m) < 4:
+            return True
+        cost = 1 if m[0] == "file_send" else len(m) - 3
+        return self.limiter.allow(m[2], cost)
+
+    # m = cmd, group, sender, message1, message2...
+    def send_group(self, m, conn):
+        ''' Sends messages to every other member of a group. Each message is stored once, tagged with who sent it,
+        and that same string is put in every member's mailbox under the group's name, so a group message is
+        uploaded and kept in memory once no matter how many members there are. A member whose mailbox is full
+        misses the message. Only members can send to a group. Members owned by another shard get the messages
+        passed on to their shard in one batch. '''
+        members = self.groups.get(m[1])
+        if len(m) < 4 or members is None or m[2] not in members:
+            conn.sendall("101")
+            return
+
+        author = m[2] + "\t"
+        payloads = [prepend(author, x) for x in m[3:]]
+        local = []
+        for member in members:
+            if member == m[2]:
+                continue
+            owner = self.ring.owner(member) if self.ring is not None else None
+            if owner is None or owner == (self.ip, self.port):
+                local.append(member)
+                for x in payloads:
+                    self.store.add(member, m[1], x)
+            else:
+                self.forwarder.put(owner, "forward\n%s\n%s\n%s" % (member, m[1], "\n".join(payloads)))
+        conn.sendall("100")
+
+        for member in local:
+            self.notify(member)
+
+    # m = cmd, member, group, message1, message2...
+    def forwarded(self, m, conn):
+        ''' Stores group messages another shard passed on for a member owned by this one. They were already charged
+        to their author on the shard they were sent to, so they skip the rate limit, which is why only connections
+        from the hosts the shards run on may send them. '''
+        if self.ring is None or conn.addr is None or conn.addr[0] not in self.peers:
+            conn.sendall("202")
+            return
+        send_batch(self.store, m, conn)
+        if len(m) >= 4:
+            self.notify(m[1])
+
+    # m = cmd, group, user
+    def group_join(self, m, conn):
+        ''' Adds a user to a group, creating the group if it doesn't exist yet. '''
+        if len(m) < 3 or not m[1].startswith(GROUP_PREFIX) or len(m[1]) == len(GROUP_PREFIX) or not m[2]:
+            conn.sendall("101")
+            return
+        self.groups.setdefault(m[1], set()).add(m[2])
+        conn.sendall("100")
+
+    # m = cmd, group, user
+    def group_leave(self, m, conn):
+        ''' Takes a user out of a group. The group goes away with its last member. '''
+        if len(m) < 3 or m[2] not in self.groups.get(m[1], ()):
+            conn.sendall("101")
+            return
+        unregister(self.groups, m[1], m[2])
+        conn.sendall("100")
+
+    # m = cmd, group
+    def group_members(self, m, conn):
+        ''' Lists the members of a group. '''
+        members = self.groups.get(m[1]) if len(m) >= 2 else None
+        if not members:
+            conn.sendall("201")
+            return
+        conn.sendall("200\n" + "".join(x + '\n' for x in sorted(members)))
+
+    # m = cmd, dest user, sender, file name, size
+    def file_send(self, m, conn):
+        ''' Starts an upload. The response is 100 followed by the id the chunks of the file are sent with. '''
+        if len(m) < 5 or not m[4].isdigit():
+            conn.sendall("101")
+            return
+        file_id = self.spool.start(m[1], m[2], m[3], int(m[4]))
+        conn.sendall("101" if file_id is None else "100\n%d" % file_id)
+
+    # m = cmd, dest user, file id; the chunk starts at start in data
+    def file_chunk(self, data, start, m, conn):
+        ''' Adds the next chunk to an upload. The chunk is written to the spool straight out of the request. '''
+        if start is None or not m[2].isdigit():
+            conn.sendall("101")
+            return
+        conn.sendall("100" if self.spool.write(m[1], int(m[2]), buffer(data, start)) else "101")
+
+    # m = cmd, current user
+    def file_list(self, m, conn):
+        ''' Lists the files waiting for a user, one per line as id, sender, file name and size separated by tabs. '''
+        files = self.spool.waiting(m[1]) if len(m) >= 2 else []
+        if not files:
+            conn.sendall("201")
+            return
+        conn.sendall("200\n" + "".join("%d\t%s\t%s\t%d\n" % (x.id, x.sender, x.name, x.size) for x in files))
+
+    # m = cmd, current user, file id
+    def file_get(self, m, conn):
+        ''' Downloads a file and removes it from the server. The response is 200 and the size of the file, after
+        which the file comes in frames that reuse the request id. Old clients get the file straight after the size
+        line instead. '''
+        taken = self.spool.take(m[1], int(m[2])) if len(m) >= 3 and m[2].isdigit() else None
+        if taken is None:
+            conn.sendall("201")
+            return
+        (spooled, data) = taken
+        if conn.framed:
+            conn.send_file(conn.request_id, "200\n%d" % spooled.size, data)
+        else:
+            conn.sendall("200\n%d\n" % spooled.size)
+            if data:
+                conn.out_buffer.append(buffer(data))
+
+    def names(self, conn):
+        ''' Lists every user with messages waiting and every group, so they can be moved when shards change. '''
+        names = list(self.store.unread) + list(self.groups)
+        if not names:
+            conn.sendall("201")
+            return
+        conn.sendall("200\n" + "".join(x + '\n' for x in names))
+
+    # m = cmd, current user, dest user (optional)
+    def subscribe(self, m, conn):
+        ''' Keeps the connection open and pushes messages from the dest user to it as soon as they are sent. Without
+        a dest user, messages from everyone are pushed in the same form receive_all uses. Anything already waiting
+        is sent back straight away as the response, PUSH_BYTES at a time. Every later push reuses the request id of
+        the subscribe request. A new subscribe replaces the connection's old one. '''
+        if not conn.framed or len(m) < 2:
+            conn.sendall("202")
+            return
+
+        sender = m[2] if len(m) >= 3 and m[2] else None
+        self.forget(conn)
+        conn.subscription = (m[1], sender, conn.request_id)
+        self.subscribers.setdefault(m[1], set()).add(conn)
+
+        to_send = collect(self.store, m[1], sender, self.stats, PUSH_BYTES)
+        conn.sendall(to_send if to_send is not None else "201")
+
+    # m = cmd, current user, dest user (empty for everyone), timeout
+    def long_poll(self, m, conn):
+        ''' Works like receive, or receive_all if the dest user is left empty, except that when there is nothing
+        waiting the response is held back until a message comes in or the timeout runs out, in which case 201 is
+        sent. '''
+        if len(m) < 3:
+            conn.sendall("202")
+            return
+
+        sender = m[2] or None
+        to_send = collect(self.store, m[1], sender, self.stats)
+        if to_send is not None:
+            conn.sendall(to_send)
+            return
+
+        try:
+            timeout = min(float(m[3]), POLL_TIMEOUT)
+        except (IndexError, ValueError):
+            timeout = POLL_TIMEOUT
+
+        self.forget(conn)
+        conn.poll = (m[1], sender, conn.request_id, time.time() + timeout)
+        self.pollers.setdefault(m[1], set()).add(conn)
+
+    def notify(self, recipient):
+        ''' Hands newly stored messages for a recipient to any connection that is waiting for them. '''
+        for conn in list(self.pollers.get(recipient, ())):
+            (user, sender, request_id, deadline) = conn.poll
+            messages = collect(self.store, user, sender, self.stats)
+            if messages is not None:
+                self.forget(conn)
+                conn.send_response(request_id, messages)
+
+        for conn in list(self.subscribers.get(recipient, ())):
+            self.push(conn)
+
+    def push(self, conn):
+        ''' Sends a subscriber the messages waiting for it. Nothing is taken out of the store while earlier responses
+        are still queued on the connection, so the messages for a subscriber that stops reading stay in the store,
+        inside its limits, and go out together once the subscriber catches up. '''
+        if conn.out_buffer:
+            return
+        (user, sender, request_id) = conn.subscription
+        messages = collect(self.store, user, sender, self.stats, PUSH_BYTES)
+        if messages is not None:
+            conn.send_response(request_id, messages)
+
+    def forget(self, conn):
+        ''' Drops any subscription or poll the connection has open. '''
+        if conn.subscription is not None:
+            unregister(self.subscribers, conn.subscription[0], conn)
+            conn.subscription = None
+
+        if conn.poll is not None:
+            unregister(self.pollers, conn.poll[0], conn)
+            conn.poll = None
+
+    def connections(self):
+        ''' Returns every open client connection. '''
+        return [x for x in self.map.values() if x is not self]
+
+    def sweep(self):
+        ''' Closes every connection that has gone quiet for longer than the read timeout, including subscribers that
+        have stopped taking what is sent to them, answers every poll that has run out of time and throws away
+        messages that have waited too long to be delivered. '''
+        now = time.time()
+        self.store.expire(now)
+        self.spool.expire(now, self.timeout)
+        if self.store.journal is not None:
+            self.store.journal.compact(self.store)
+        if self.limiter is not None:
+            self.limiter.prune(now)
+        for x in self.connections():
+            if x.poll is not None and x.poll[3] <= now:
+                request_id = x.poll[2]
+                self.forget(x)
+                x.send_response(request_id, "201")
+                x.last_activity = now
+            elif x.last_activity < now - x.timeout and not x.waiting():
+                x.close()
+
+        if self.stats_file is not None and now - self.last_dump >= self.stats_interval:
+            self.last_dump = now
+            try:
+                self.stats.dump(self.store, self.stats_file)
+            except (EnvironmentError, ValueError):
+                print "Could not write the stats file %s." % self.stats_file
+
+    def serve_forever(self):
+        ''' Runs the event loop until stop() is called. '''
+        self.running = True
+        last_sweep = time.time()
+        while self.running and self.map:
+            asyncore.loop(timeout=SWEEP_INTERVAL, use_poll=True, map=self.map, count=1)
+
+            # Everything stored on this trip around the loop goes to the log in one write.
+            if self.store.journal is not None:
+                self.store.journal.flush()
+
+            if time.time() - last_sweep >= SWEEP_INTERVAL:
+                self.sweep()
+                last_sweep = time.time()
+        self.shutdown()
+
+    def stop(self, *args):
+        ''' Asks the event loop to finish. Safe to use as a signal handler. '''
+        self.running = False
+
+    def shutdown(self):
+        ''' Stops accepting connections and closes every open one. '''
+        for x in self.connections():
+            x.close()
+        self.close()
+        if self.spare is not None:
+            self.spare.close()
+        self.spool.close()
+        if self.store.journal is not None:
+            self.store.journal.close()
+
+def connection_limit(max_connections):
+    ''' Lowers max_connections so that many connections, and as many again being turned away, fit in the number of
+    files the process is allowed to have open. '''
+    if resource is None:
+        return max_connections
+    files = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if files == resource.RLIM_INFINITY:
+        return max_connections
+    return max(1, min(max_connections, (files - RESERVED_FILES) // 2))
+
+def unregister(table, name, item):
+    ''' Removes a connection or a group member from a dictionairy of sets, dropping the name once its set is empty. '''
+    if name in table:
+        table[name].discard(item)
+        if len(table[name]) == 0:
+            del table[name]
+
+def shard_hosts(shards):
+    ''' Returns the addresses the shards of a relay connect from. A host that can't be looked up is kept as it is. '''
+    hosts = set()
+    for (host, port) in shards:
+        try:
+            hosts.add(socket.gethostbyname(host))
+        except socket.error:
+            hosts.add(host)
+    return hosts
+
+def chunk_header(data):
+    ''' Reads the command, recipient and file id off the front of a file_chunk request. Returns them as a list along
+    with where the chunk starts in data, or None instead of the start if the header isn't all there. '''
+    recipient_end = data.find("\n", len("file_chunk\n"))
+    id_end = data.find("\n", recipient_end + 1) if recipient_end >= 0 else -1
+    if id_end < 0:
+        return data.split("\n"), None
+    return data[:id_end].split("\n"), id_end + 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Relays messages between enigma chat clients.")
+    parser.add_argument("--ip", default=IP, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on.")
+    parser.add_argument("--timeout", type=float, default=READ_TIMEOUT,
+                        help="Seconds a connection can stay idle before it is closed.")
+    parser.add_argument("--mailbox-limit", type=int, default=MAILBOX_LIMIT,
+                        help="Most messages one sender can leave waiting for one recipient.")
+    parser.add_argument("--mailbox-bytes", type=int, default=MAILBOX_BYTES,
+                        help="Most bytes one sender can leave waiting for one recipient.")
+    parser.add_argument("--recipient-limit", type=int, default=RECIPIENT_LIMIT,
+                        help="Most messages, from everyone together, that can wait for one recipient.")
+    parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT,
+                        help="Messages a user can send per second on average. 0 turns the limit off.")
+    parser.add_argument("--rate-burst", type=int, default=RATE_BURST,
+                        help="Messages a user can send at once after being quiet.")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Most client connections open at once. Any more are told the server is busy.")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG,
+                        help="Connections the kernel queues up while the server is busy.")
+    parser.add_argument("--memory-limit", type=int, default=MEMORY_LIMIT,
+                        help="Most bytes of undelivered messages the server holds.")
+    parser.add_argument("--ttl", type=float, default=MESSAGE_TTL,
+                        help="Seconds an undelivered message is kept before it is thrown away.")
+    parser.add_argument("--data-dir", help="Directory to keep undelivered messages in across restarts.")
+    parser.add_argument("--stats-file", help="File to write the server's stats to as JSON every so often.")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="Seconds between writes of the stats file.")
+    parser.add_argument("--spool-dir", help="Directory to keep files waiting to be downloaded in. A temporary one "
+                                            "is used by default.")
+    parser.add_argument("--max-file-size", type=int, default=MAX_FILE_SIZE,
+                        help="Biggest file, in bytes, that can be sent through the server.")
+    parser.add_argument("--recipient-file-bytes", type=int, default=RECIPIENT_FILE_BYTES,
+                        help="Most bytes of files that can be waiting for one user.")
+    parser.add_argument("--spool-bytes", type=int, default=SPOOL_BYTES,
+                        help="Most bytes of files the server keeps waiting to be downloaded.")
+    parser.add_argument("--shards", help="Every shard of the relay, this one included, as host:port,host:port...")
+    args = parser.parse_args()
+
+    shards = None
+    if args.shards is not None:
+        shards = parse_shards(args.shards)
+        if (args.ip, args.port) not in shards:
+            parser.error("--shards has to include this server's --ip and --port")
+
+    store = MailboxStore(args.mailbox_limit, args.mailbox_bytes, args.memory_limit, args.ttl, args.recipient_limit)
+    if args.data_dir is not None:
+        log = MessageLog(args.data_dir)
+        print "Restored %d undelivered messages." % log.recover(store)
+        store.journal = log
+        log.start()
+
+    spool = FileSpool(args.spool_dir, args.max_file_size, args.ttl, args.recipient_file_bytes, args.spool_bytes)
+    limiter = RateLimiter(args.rate_limit, args.rate_burst) if args.rate_limit > 0 else None
+    server = RelayServer(args.ip, args.port, args.timeout, store, args.stats_file, args.stats_interval, shards, spool,
+                         limiter, args.max_connections, args.backlog)
+    signal.signal(signal.SIGINT, server.stop)
+    signal.signal(signal.SIGTERM, server.stop)
+
+    if server.max_connections < args.max_connections:
+        print "Only %d connections fit in the open file limit." % server.max_connections
+    print "Starting up server. IP: %s. Port: %s" % (server.ip, server.port)
+    server.serve_forever()
+    print "Server stopped."
 
 # m = cmd, dest user, sender, messge
-def send(all_messages, m, conn):
+def send(store, m, conn):
+    '''
+    Takes the encrypted messages sent by client and stores them in the recipient's mailbox
+
+    :param store: MailboxStore with all messages
+    :param m: list with new messages from client
+    :param conn: connection object
+    :return: None
     '''
-    Takes the encrypted messages sent by client and stores them in dictionairy
+    if len(m) < 4:
+        conn.sendall("101")
+        return
 
-    :param all_messages: dictionairy with all messages
+    # The store turns the message away if the mailbox or the server is full.
+    if store.add(m[1], m[2], m[3]):
+        conn.sendall("100")
+    else:
+        conn.sendall("101")
+
+# m = cmd, dest user, sender, message1, message2...
+def send_batch(store, m, conn):
+    '''
+    Stores several messages from the same sender to the same recipient in one request. Messages are stored in order
+    and the first one that doesn't fit stops the batch, so a partly stored batch never skips a message.
+
+    :param store: MailboxStore with all messages
     :param m: list with new messages from client
     :param conn: connection object
-    :return: Nont
+    :return: None
     '''
+    if len(m) < 4:
+        conn.sendall("101\n0")
+        return
 
-    # If the recipient is not in the message dictionairy, a new entry is added.
-    # If the recipient is in the entry dictionairy, a new list of messages is added
-    if m[1] in all_messages.keys():
+    stored = 0
+    for x in m[3:]:
+        if not store.add(m[1], m[2], x):
+            break
+        stored += 1
 
-        # If the sender is already in the dictionairy of senders, the message is appended to the list for
-        # that sender. Else, a new sender is added to the recipient dictionairy.
-        if m[2] in all_messages[m[1]].keys():
-            all_messages[m[1]][m[2]].append(m[3])
-        else:
-            all_messages[m[1]][m[2]] = [m[3]]
+    if stored == len(m) - 3:
+        conn.sendall("100")
     else:
-        all_messages[m[1]] = {m[2]: [m[3]]}
-    conn.sendall("100")
-    if all_messages != {}: print all_messages
+        conn.sendall("101\n%d" % stored)
 
 # m = cmd, dest user, sender
-def receive(all_messages, m, conn):
+def receive(store, m, conn, stats=None):
     '''
     Downloads unread messages from server.
 
-    :param all_messages: dictionairy with all messages
+    :param store: MailboxStore with all messages
     :param m: messages from client
     :param conn: connection object
+    :param stats: ServerStats that traced messages are recorded in, if any
     :return: None
     '''
-    to_send = "201"
-
-    # Pulls the messages for the user and dest user from the dictionairy.
-    # If the user has no more mail, deletes the dictionairy entry.
-    if m[1] in all_messages.keys():
-        if m[2] in all_messages[m[1]]:
-            to_send = "200\n"
-            for x in all_messages[m[1]][m[2]]:
-                to_send += x + '\n'
-            del all_messages[m[1]][m[2]]
-        if all_messages[m[1]] == {}:
-            del all_messages[m[1]]
+    to_send = None
+    if len(m) >= 3:
+        to_send = collect(store, m[1], m[2], stats)
+    if to_send is None:
+        to_send = "201"
     conn.sendall(to_send)
 
 # m = cmd, current user
-def check_messages(all_messages, m, conn):
+def receive_all(store, m, conn, stats=None):
+    '''
+    Downloads every unread message from every sender in one go. Each line of the response is the sender and the
+    message separated by a tab.
+
+    :param store: MailboxStore with all messages
+    :param m: messages from client
+    :param conn: connection object
+    :param stats: ServerStats that traced messages are recorded in, if any
+    :return: None
+    '''
+    to_send = None
+    if len(m) >= 2:
+        to_send = collect(store, m[1], None, stats)
+    if to_send is None:
+        to_send = "201"
+    conn.sendall(to_send)
+
+def collect(store, recipient, sender, stats=None, max_bytes=None):
+    '''
+    Removes the messages a sender has left for a recipient and builds the response that delivers them. With a
+    sender of None, messages from everyone are removed and each line is tagged with who sent it.
+
+    :param store: MailboxStore with all messages
+    :param recipient: user the messages were sent to
+    :param sender: user who sent the messages, or None for everyone
+    :param stats: ServerStats that traced messages are recorded in, if any
+    :param max_bytes: about how many bytes of messages to take at most, or None for all of them
+    :return: the 200 response, or None if there were no messages
+    '''
+    now = time.time()
+    if sender is None:
+        messages = ["%s\t%s" % (x, y.payload if not y.payload.startswith(TRACE_MARK) else delivered(y, now, stats))
+                    for (x, y) in store.drain_all(recipient, max_bytes)]
+    else:
+        messages = [x.payload if not x.payload.startswith(TRACE_MARK) else delivered(x, now, stats)
+                    for x in store.drain(recipient, sender, max_bytes)]
+    if len(messages) == 0:
+        return None
+    return "200\n" + "".join(x + '\n' for x in messages)
+
+def delivered(message, now, stats):
+    '''
+    Adds the time a traced message was stored and the time it is being delivered to its trace header.
+
+    :param message: Message that is leaving the store
+    :param now: time it is being delivered
+    :param stats: ServerStats to record how long it waited in, if any
+    :return: the payload to deliver
+    '''
+    (payload, encrypted) = relay_stamp(message.payload, message.stored, now)
+    if stats is not None:
+        stats.traced(encrypted, message.stored, now)
+    return payload
+
+# m = cmd, current user
+def check_messages(store, m, conn):
     '''
     Checks to see if the current user has any new messages from users they aren't actively chatting with
 
-    :param all_messages: dictionairy with all messages
+    :param store: MailboxStore with all messages
     :param m: messages from client
     :param conn: connection object
     :return: None
     '''
-    to_send = ""
-
-    # If the current user is in the dictionairy with all the messages, returns the names of the users
-    # who have sent the current user a message.
-    if m[1] in all_messages.keys():
-        if all_messages[m[1]] != {}:
-            to_send += '200\n'
-            for x in all_messages[m[1]].keys():
-                to_send += x + '\n'
-        else:
-            to_send = '201'
+    # Returns the names of the users who have sent the current user a message.
+    senders = store.senders(m[1]) if len(m) >= 2 else []
+    if len(senders) > 0:
+        to_send = "200\n" + "".join(x + '\n' for x in senders)
     else:
         to_send = '201'
 
     conn.sendall(to_send)
 
-main()
+def test():
+    import threading
+    from enigma import testit
+    from enigma_protocol import FramedConnection
+    server = RelayServer("127.0.0.1", 0, limiter=RateLimiter(1, 3))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        conn = FramedConnection("127.0.0.1", server.port)
+        testit(conn.request("send\nbob\nalice\nhello") == "100")
+        testit(conn.request("check\nbob") == "200\nalice\n")
+        testit(conn.request("receive\nbob\nalice") == "200\nhello\n")
+        testit(conn.request("receive\nbob\nalice") == "201")
+
+        # A sender that goes over their rate limit is told to wait, whatever name they put down as the sender.
+        testit(conn.request("send_batch\nbob\ncarol\n1\n2") == "100")
+        testit(conn.request("send_batch\nbob\ncarol\n3\n4") == BUSY)
+        testit(conn.request("send_batch\nbob\n#group\n1\n2\n3\n4") == BUSY)
+
+        # Only other shards may pass group messages on, and this server has none.
+        testit(conn.request("forward\nbob\n#group\n1") == "202")
+        testit(conn.request("receive_all\nbob") == "200\ncarol\t1\ncarol\t2\n")
+
+        # Files go up in chunks of raw bytes, line breaks included.
+        file_id = conn.request("file_send\nbob\nalice\nname\n6").split("\n")[1]
+        testit(conn.request("file_chunk\nbob\n%s\na\nb" % file_id) == "100")
+        testit(conn.request("file_chunk\nbob\n%s" % file_id) == "101")
+        testit(conn.request("file_chunk\nbob\n%s\n\x00\n\xff" % file_id) == "100")
+        testit(conn.request("file_end\nbob\n%s" % file_id) == "100")
+        testit(conn.request("file_list\nbob") == "200\n%s\talice\tname\t6\n" % file_id)
+        testit(conn.request("file_get\nbob\n%s" % file_id) == "200\n6")
+        testit(conn.read_frame()[1] == "a\nb\x00\n\xff")
+
+        # Names that aren't UTF-8 don't stop the stats being sent.
+        conn.request("send\n\xffbob\nalice\nhi")
+        stats = json.loads(conn.request("stats")[4:])
+        testit(stats['mailbox']['top_recipients'] == [{'recipient': u"\ufffdbob", 'unread': 1}])
+        conn.close()
+    finally:
+        server.stop()
+        thread.join()
+
+if __name__ == '__main__':
+    main()
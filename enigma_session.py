@@ -0,0 +1,321 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: The part of the chat client that talks to the server, without any of the typing. A ChatSession keeps
+#          track of any number of conversations, each with its own key, over one connection to the server, so a bot
+#          can talk to hundreds of people from one process:
+#
+#              def reply(conversation, sender, plain_text, cipher_text):
+#                  session.send(conversation.peer, "You said: " + plain_text)
+#
+#              session = ChatSession("bot", "default key", handler=reply)
+#              session.conversation("alice", "alice's key")
+#              session.start()
+#
+# One thread reads everything the server sends. Responses are handed to whoever is waiting on that request id and
+# pushed messages are handed to a small pool of worker threads to decrypt, so a long message never holds up the
+# connection. Every conversation always goes to the same worker, which keeps its messages in order.
+#
+# Given a trace_sample, that fraction of the messages sent are traced on their way to the recipient, and the
+# session's tracer keeps the timings of every traced message that comes in.
+#
+######################################################################
+
+import socket
+import threading
+import time
+from Queue import Queue, Empty
+from enigma import clean_text, compile_key
+from enigma_protocol import GROUP_PREFIX, FramedConnection, ProtocolError
+from enigma_shard import ShardedPool, route_name
+from enigma_trace import TRACE_MARK, Tracer, split_trace
+
+# Threads that decrypt incoming messages.
+WORKERS = 2
+
+# Seconds to wait before reconnecting after the server drops the connection.
+RECONNECT_DELAY = 5
+
+# Seconds the server is asked to hold a poll request open for when it can't push messages.
+POLL_TIMEOUT = 25
+
+# Seconds to wait for the response to a request.
+REQUEST_TIMEOUT = 60
+
+class Conversation():
+    ''' Someone, or a group, being talked to and the key used with them. The key is compiled when it is set, so
+    encrypting and decrypting never have to build its rotors. '''
+    __slots__ = ('peer', 'key', 'cipher')
+
+    def __init__(self, peer, key):
+        self.peer = peer
+        self.set_key(key)
+
+    def set_key(self, key):
+        self.key = key
+        self.cipher = compile_key(key)
+
+    def encrypt(self, text):
+        return self.cipher.encrypt(clean_text(text))
+
+    def decrypt(self, cipher_text):
+        return self.cipher.decrypt(clean_text(cipher_text))
+
+class ChatSession():
+    ''' Sends and receives messages for one user. handler is called from a worker thread as
+    handler(conversation, sender, plain_text, cipher_text) for every message that comes in. For group messages the
+    conversation is the group and sender is the member who wrote it. Messages from someone without a conversation
+    start a new one with the default key.
+
+    Given a list of (host, port) as shards, the connection goes to the shard that owns the user, and requests about
+    anybody else go to their own shard. '''
+    def __init__(self, user, key, ip="127.0.0.1", port=5005, shards=None, handler=None, workers=WORKERS,
+                 trace_sample=0.0):
+        self.user = user
+        self.default_key = key
+        self.handler = handler
+        self.ip = ip
+        self.port = port
+        self.tracer = Tracer(trace_sample)
+
+        self.pool = None
+        if shards is not None:
+            self.pool = ShardedPool(shards)
+            (self.ip, self.port) = self.pool.ring.owner(user)
+
+        # peer: Conversation
+        self.conversations = {}
+        self.conversations_lock = threading.Lock()
+
+        # The connection, and a queue for the response to every request sent over it that hasn't come back yet.
+        self.conn = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # Request id that pushed messages come back with, once start() has subscribed.
+        self.subscription = None
+        self.listening = False
+        self.active = True
+
+        # Thread that polls for messages when the server can't push them, started the first time it's needed.
+        self.poller = None
+
+        self.queues = [Queue() for x in range(workers)]
+        self.workers = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self.work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def conversation(self, peer, key=None):
+        ''' Returns the conversation with a peer, starting one with the default key if there isn't one. Passing a
+        key changes the key the conversation uses. '''
+        with self.conversations_lock:
+            conversation = self.conversations.get(peer)
+            if conversation is None:
+                conversation = self.conversations[peer] = Conversation(peer, key or self.default_key)
+            elif key is not None and key != conversation.key:
+                conversation.set_key(key)
+        return conversation
+
+    def has_conversation(self, peer):
+        return peer in self.conversations
+
+    def connect(self):
+        ''' Opens the connection, if it isn't already, and starts the thread that reads from it. '''
+        with self.lock:
+            if self.conn is None:
+                self.conn = FramedConnection(self.ip, self.port)
+                thread = threading.Thread(target=self.read, args=(self.conn,))
+                thread.daemon = True
+                thread.start()
+            return self.conn
+
+    def start(self):
+        ''' Starts having messages pushed by the server as soon as they are sent. '''
+        self.listening = True
+        self.subscribe()
+
+    def subscribe(self):
+        conn = self.connect()
+        with self.lock:
+            self.subscription = conn.new_request_id()
+        conn.send_request("%s\n%s" % ("subscribe", self.user), self.subscription)
+
+    def request(self, payload, timeout=REQUEST_TIMEOUT):
+        ''' Sends a request and waits for its response. Safe to call from any number of threads at once. If the
+        connection turns out to have been closed, for sitting idle too long, the request is tried once more on a new
+        one. Raises socket.error if that fails too. '''
+        if self.pool is not None and self.pool.ring.owner(route_name(payload)) != (self.ip, self.port):
+            return self.pool.request(payload)
+
+        try:
+            return self.request_once(payload, timeout)
+        except socket.timeout:
+            raise
+        except socket.error:
+            return self.request_once(payload, timeout)
+
+    def request_once(self, payload, timeout):
+        conn = self.connect()
+        response = Queue(1)
+
+        # The queue is in place before the request goes out, so the reader always has somewhere to put the
+        # response. The lock isn't held while sending, so the reader is never kept from draining the connection.
+        with self.lock:
+            request_id = conn.new_request_id()
+            self.pending[request_id] = response
+        try:
+            conn.send_request(payload, request_id)
+        except socket.error:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise
+
+        try:
+            response = response.get(timeout=timeout)
+        except Empty:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise socket.timeout("No response from the server")
+        if response is None:
+            raise socket.error("Connection to the server lost")
+        return response
+
+    def read(self, conn):
+        ''' Reads everything the server sends over a connection until it closes. If the session is listening, a new
+        connection is made and subscribed after a short wait. '''
+        while True:
+            try:
+                (request_id, response) = conn.read_frame()
+            except (socket.error, ProtocolError):
+                break
+
+            with self.lock:
+                waiting = self.pending.pop(request_id, None)
+                subscription = self.subscription
+            if waiting is not None:
+                waiting.put(response)
+            elif request_id == subscription:
+                if response == "202":
+                    # The server can't push messages, so ask for them instead. Every reconnect is told the same
+                    # thing, and the one poller keeps going across them.
+                    self.start_poller()
+                else:
+                    self.deliver(response)
+
+        with self.lock:
+            conn.close()
+            if self.conn is conn:
+                self.conn = None
+            pending = self.pending
+            self.pending = {}
+            self.subscription = None
+        for x in pending.values():
+            x.put(None)
+
+        while self.active and self.listening:
+            time.sleep(RECONNECT_DELAY)
+            try:
+                self.subscribe()
+                return
+            except socket.error:
+                pass
+
+    def start_poller(self):
+        with self.lock:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll)
+                self.poller.daemon = True
+                self.poller.start()
+
+    def poll(self):
+        ''' Keeps a poll request open with the server so that messages show up as soon as they are sent. '''
+        while self.active:
+            try:
+                response = self.request("%s\n%s\n\n%s" % ("poll", self.user, POLL_TIMEOUT), POLL_TIMEOUT * 2)
+            except (socket.error, ProtocolError):
+                time.sleep(RECONNECT_DELAY)
+                continue
+            self.deliver(response)
+
+    def deliver(self, response):
+        ''' Hands the messages in a receive_all or push response to the workers. Every line is the sender, a tab and
+        the message, and group messages have the member who wrote them and another tab in front of the message. '''
+        lines = response.split('\n')
+        if lines[0] != '200':
+            return
+
+        received = time.time()
+        for x in lines[1:-1]:
+            (peer, x) = x.split('\t', 1)
+            trace = None
+            if x.startswith(TRACE_MARK):
+                (trace, x) = split_trace(x)
+            sender = peer
+            if peer.startswith(GROUP_PREFIX):
+                (sender, x) = x.split('\t', 1)
+            self.queues[hash(peer) % len(self.queues)].put((self.conversation(peer), sender, x, trace, received))
+
+    def work(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            if self.handler is None:
+                continue
+            try:
+                self.handle(*job)
+            except Exception as e:
+                # A message that can't be decrypted, or a handler that trips over it, mustn't stop this worker, or
+                # every conversation that hashes to it would go quiet.
+                print "Could not handle a message from %s: %s" % (job[1], e)
+
+    def handle(self, conversation, sender, cipher_text, trace, received):
+        ''' Decrypts a message and hands it to the handler, timing it if it was traced. '''
+        if trace is None:
+            self.handler(conversation, sender, conversation.decrypt(cipher_text), cipher_text)
+            return
+
+        decrypting = time.time()
+        plain_text = conversation.decrypt(cipher_text)
+        self.tracer.finish(trace, sender, received, decrypting, time.time())
+        self.handler(conversation, sender, plain_text, cipher_text)
+
+    def receive(self):
+        ''' Downloads every message waiting on the server and hands it to the handler. '''
+        self.deliver(self.request("%s\n%s" % ("receive_all", self.user)))
+
+    def encrypt(self, peer, text):
+        ''' Encrypts a message with the peer's key, ready to send. Messages picked to be traced come back with their
+        trace header. '''
+        conversation = self.conversation(peer)
+        if not self.tracer.sample():
+            return conversation.encrypt(text)
+        started = time.time()
+        return self.tracer.start(conversation.encrypt(text), started)
+
+    def send(self, peer, *texts):
+        ''' Encrypts messages with the peer's key and sends them in one request. Returns the server's response. '''
+        return self.request("\n".join(["send_batch", peer, self.user] + [self.encrypt(peer, x) for x in texts]))
+
+    def close(self):
+        ''' Stops listening, closes the connection and waits for the workers to finish the messages they have. '''
+        self.active = False
+        self.listening = False
+        with self.lock:
+            conn = self.conn
+        if conn is not None:
+            conn.close()
+        if self.pool is not None:
+            self.pool.close()
+        for queue in self.queues:
+            queue.put(None)
+
+        # Waits for the workers so they aren't cut off half way through a message when the program exits.
+        for thread in self.workers:
+            if thread is not threading.current_thread():
+                thread.join()
@@ -0,0 +1,341 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Spreads the relay over several server processes. Each process, or shard, owns the mailboxes of the users
+#          whose names hash to its part of a ring, so adding a shard only moves the users that land on its part.
+#
+# Every request is sent to the shard that owns the name on its second line: the recipient for send, the current
+# user for receive, check, subscribe and poll, and the group for the group commands. Clients can do that themselves
+# with a ShardedPool, or old clients can talk to a router process that passes each frame on to the right shard.
+#
+#   python enigma_shard.py local --count 3              Starts three shards on ports 5006, 5007 and 5008.
+#   python enigma_shard.py router --shards ...          Listens on port 5005 and routes to the given shards.
+#   python enigma_shard.py rebalance --old ... --new ...
+#                                                       Moves mailboxes and groups to the shards that own them now.
+#
+######################################################################
+
+import argparse
+import bisect
+import hashlib
+import os
+import signal
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+from itertools import groupby
+from Queue import Queue
+from enigma_protocol import (FRAME_MAGIC, GROUP_PREFIX, ConnectionPool, FrameDecoder, ProtocolError, encode_frame,
+                             read_frame)
+
+# Points each shard gets on the ring. More points spread users more evenly.
+RING_REPLICAS = 100
+
+# Port the router listens on, and the first port local shards are given.
+ROUTER_PORT = 5005
+SHARD_PORT = 5006
+
+BUFFER = 65536
+
+# Most messages moved in one request while rebalancing, which keeps every request inside the senders' rate limits.
+MOVE_BATCH = 100
+
+# Seconds to wait before trying again when a shard says it is busy.
+BUSY_DELAY = 0.5
+
+def parse_shards(text):
+    ''' Turns "host:port,host:port" into a list of (host, port). '''
+    shards = []
+    for x in text.split(","):
+        (host, port) = x.strip().rsplit(":", 1)
+        shards.append((host, int(port)))
+    return shards
+
+def shard_name(shard):
+    return "%s:%d" % shard
+
+def route_name(payload):
+    ''' Returns the name a request is routed by, which is the second line of every command. '''
+    lines = payload.split("\n", 2)
+    return lines[1] if len(lines) >= 2 else ""
+
+def ring_hash(text):
+    return int(hashlib.md5(text).hexdigest()[:16], 16)
+
+class ShardRing():
+    ''' A consistent hash ring. A name belongs to the first shard point at or after its own hash. '''
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        if not shards:
+            raise ValueError("A ring needs at least one shard")
+        self.shards = list(shards)
+        points = sorted((ring_hash("%s#%d" % (shard_name(x), y)), x) for x in self.shards for y in range(replicas))
+        self.hashes = [x[0] for x in points]
+        self.owners = [x[1] for x in points]
+
+    def owner(self, name):
+        ''' Returns the (host, port) of the shard that owns a name. '''
+        index = bisect.bisect(self.hashes, ring_hash(name)) % len(self.hashes)
+        return self.owners[index]
+
+class ShardedPool():
+    ''' Works like a ConnectionPool, except that every request goes to the shard that owns its name. '''
+    def __init__(self, shards, timeout=None):
+        self.ring = ShardRing(shards)
+        self.pools = dict((x, ConnectionPool(x[0], x[1], timeout=timeout)) for x in self.ring.shards)
+
+    def request(self, payload):
+        return self.pools[self.ring.owner(route_name(payload))].request(payload)
+
+    def close(self):
+        for x in self.pools.values():
+            x.close()
+
+class Forwarder():
+    ''' Passes requests on to other shards in the background, so a shard's event loop never waits on another shard.
+    Each shard gets its own queue and thread, which keeps the requests to one shard in order. A shard that says it is
+    busy is waited out. A request that can't be delivered after one retry, or that the shard turns away, is dropped
+    and reported. '''
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def put(self, shard, payload):
+        with self.lock:
+            queue = self.queues.get(shard)
+            if queue is None:
+                queue = self.queues[shard] = Queue()
+                thread = threading.Thread(target=self.run, args=(shard, queue))
+                thread.daemon = True
+                thread.start()
+        queue.put(payload)
+
+    def run(self, shard, queue):
+        pool = ConnectionPool(shard[0], shard[1])
+        while True:
+            payload = queue.get()
+            try:
+                reply = pool.request(payload)
+                while reply == "300":
+                    time.sleep(BUSY_DELAY)
+                    reply = pool.request(payload)
+            except (socket.error, ProtocolError):
+                print "Could not forward a request to %s." % shard_name(shard)
+                continue
+            if not reply.startswith("100"):
+                # A full mailbox is the same as for a member on this shard. Anything else means the shard doesn't
+                # take forwarded messages from this one.
+                print "%s turned away a forwarded request." % shard_name(shard)
+
+class RouterHandler(SocketServer.BaseRequestHandler):
+    ''' One client connection to the router. Each frame is sent on to the shard that owns it over a connection kept
+    just for this client, so request ids never clash and pushed messages come back over the same path. '''
+    def handle(self):
+        self.upstream = {}
+        self.send_lock = threading.Lock()
+        try:
+            data = self.request.recv(BUFFER)
+            if not data:
+                return
+            if data[0] != FRAME_MAGIC:
+                self.forward_legacy(data)
+                return
+
+            decoder = FrameDecoder()
+            while data:
+                for (request_id, payload) in decoder.feed(data):
+                    if payload.startswith("forward\n"):
+                        # Only shards may pass messages on. Through the router, clients would look like one.
+                        with self.send_lock:
+                            self.request.sendall(encode_frame(request_id, "202"))
+                        continue
+                    self.connection(self.server.ring.owner(route_name(payload))).sendall(
+                        encode_frame(request_id, payload))
+                data = self.request.recv(BUFFER)
+        except (socket.error, ProtocolError):
+            pass
+        finally:
+            for x in self.upstream.values():
+                x.close()
+
+    def forward_legacy(self, data):
+        ''' Old clients send one command and read until the connection closes. '''
+        if data.startswith("forward\n"):
+            self.request.sendall("202")
+            return
+        shard = self.server.ring.owner(route_name(data))
+        upstream = socket.create_connection(shard)
+        try:
+            upstream.sendall(data)
+            while True:
+                response = upstream.recv(BUFFER)
+                if not response:
+                    break
+                self.request.sendall(response)
+        finally:
+            upstream.close()
+
+    def connection(self, shard):
+        ''' Returns this client's connection to a shard, opening it and starting to copy its responses back the first
+        time it is needed. '''
+        upstream = self.upstream.get(shard)
+        if upstream is None:
+            upstream = self.upstream[shard] = socket.create_connection(shard)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self.copy_back, args=(upstream,))
+            thread.daemon = True
+            thread.start()
+        return upstream
+
+    def copy_back(self, upstream):
+        try:
+            while True:
+                (request_id, payload) = read_frame(upstream)
+                with self.send_lock:
+                    self.request.sendall(encode_frame(request_id, payload))
+        except (socket.error, ProtocolError):
+            # The shard went away, so the client has to reconnect.
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class Router(SocketServer.ThreadingTCPServer):
+    ''' Lets clients that only know about one server talk to a sharded relay. '''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, ip, port, shards):
+        self.ring = ShardRing(shards)
+        SocketServer.ThreadingTCPServer.__init__(self, (ip, port), RouterHandler)
+
+def start_shards(ip, port, count, server_args=()):
+    ''' Starts count relay servers on consecutive ports, each told about all the others, and returns the processes
+    and the list of shards. '''
+    shards = [(ip, port + x) for x in range(count)]
+    listing = ",".join(shard_name(x) for x in shards)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "enigma_server.py")
+    processes = []
+    for shard in shards:
+        processes.append(subprocess.Popen([sys.executable, path, "--ip", shard[0], "--port", str(shard[1]),
+                                           "--shards", listing] + list(server_args)))
+    return processes, shards
+
+def rebalance(old, new):
+    ''' Moves the mailboxes and groups on the old shards that belong to a different shard on the new ring. Clients
+    should already be using the new list of shards, so nothing new arrives at the old owner while this runs. Returns
+    how many messages were moved. '''
+    ring = ShardRing(new)
+    moved = 0
+    for shard in old:
+        source = ConnectionPool(shard[0], shard[1])
+        response = source.request("names").split("\n")
+        names = response[1:-1] if response[0] == "200" else []
+
+        for name in names:
+            owner = ring.owner(name)
+            if owner == shard:
+                continue
+            target = ConnectionPool(owner[0], owner[1])
+            if name.startswith(GROUP_PREFIX):
+                move_group(source, target, name)
+            else:
+                moved += move_mailboxes(source, target, name)
+            target.close()
+        source.close()
+    return moved
+
+def move_group(source, target, group):
+    ''' Moves the members of a group from one shard to another. '''
+    response = source.request("group_members\n%s" % group).split("\n")
+    if response[0] != "200":
+        return
+    for member in response[1:-1]:
+        target.request("group_join\n%s\n%s" % (group, member))
+        source.request("group_leave\n%s\n%s" % (group, member))
+
+def move_mailboxes(source, target, recipient):
+    ''' Moves every message waiting for a recipient from one shard to another. Messages the new shard turns away
+    are put back on the old one rather than being lost. '''
+    response = source.request("receive_all\n%s" % recipient).split("\n")
+    if response[0] != "200":
+        return 0
+
+    moved = 0
+    lines = [x.split("\t", 1) for x in response[1:-1]]
+    for (sender, messages) in groupby(lines, lambda x: x[0]):
+        messages = [x[1] for x in messages]
+        for x in range(0, len(messages), MOVE_BATCH):
+            batch = messages[x:x + MOVE_BATCH]
+            stored = send_batch(target, recipient, sender, batch)
+            if stored < len(batch):
+                send_batch(source, recipient, sender, batch[stored:])
+            moved += stored
+    return moved
+
+def send_batch(pool, recipient, sender, messages):
+    ''' Stores messages on a shard, waiting for its rate limit whenever it is busy. Returns how many were stored. '''
+    while True:
+        reply = pool.request("send_batch\n%s\n%s\n%s" % (recipient, sender, "\n".join(messages))).split("\n")
+        if reply[0] == "100":
+            return len(messages)
+        if reply[0] == "101":
+            return int(reply[1])
+        time.sleep(BUSY_DELAY)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the enigma relay as several shards.")
+    commands = parser.add_subparsers(dest="command")
+
+    local = commands.add_parser("local", help="Starts shards on this machine, with a router in front of them.")
+    local.add_argument("--count", type=int, default=3, help="How many shards to start.")
+    local.add_argument("--ip", default="127.0.0.1", help="Address the shards and router listen on.")
+    local.add_argument("--port", type=int, default=SHARD_PORT, help="Port of the first shard.")
+    local.add_argument("--router-port", type=int, default=ROUTER_PORT, help="Port of the router. 0 for none.")
+
+    router = commands.add_parser("router", help="Routes requests from clients to the shard that owns them.")
+    router.add_argument("--ip", default="127.0.0.1", help="Address to listen on.")
+    router.add_argument("--port", type=int, default=ROUTER_PORT, help="Port to listen on.")
+    router.add_argument("--shards", required=True, help="Every shard, as host:port,host:port...")
+
+    move = commands.add_parser("rebalance", help="Moves messages and groups after shards are added or removed.")
+    move.add_argument("--old", required=True, help="The shards before the change, as host:port,host:port...")
+    move.add_argument("--new", required=True, help="The shards after the change, as host:port,host:port...")
+    args = parser.parse_args()
+
+    if args.command == "rebalance":
+        print "Moved %d messages." % rebalance(parse_shards(args.old), parse_shards(args.new))
+        return
+
+    processes = []
+    if args.command == "local":
+        (processes, shards) = start_shards(args.ip, args.port, args.count)
+        print "Started shards: %s" % ",".join(shard_name(x) for x in shards)
+        router_port = args.router_port
+    else:
+        shards = parse_shards(args.shards)
+        router_port = args.port
+
+    try:
+        if router_port:
+            server = Router(args.ip, router_port, shards)
+            signal.signal(signal.SIGTERM, lambda *x: sys.exit(0))
+            print "Routing %s:%d to %d shards." % (args.ip, router_port, len(shards))
+            server.serve_forever()
+        else:
+            while True:
+                time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for x in processes:
+            x.terminate()
+            x.wait()
+
+if __name__ == '__main__':
+    main()
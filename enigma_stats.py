@@ -0,0 +1,184 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Counters and latency histograms for the relay server. Recording a request costs a couple of dictionary
+#          updates, so they can be left on all the time.
+#
+######################################################################
+
+import heapq
+import json
+import math
+import os
+import time
+
+# How many recipients with the most unread messages are listed.
+TOP_RECIPIENTS = 10
+
+def printable(name):
+    ''' Returns a user name as unicode for JSON output. Names are whatever bytes clients sent, so any that aren't
+    UTF-8 are shown with replacement characters rather than stopping the whole file being written. '''
+    return name.decode("utf-8", "replace")
+
+def write_json(data, path):
+    ''' Writes data to a JSON file. The file is replaced in one step so readers never see half of it. If writing
+    fails, the file is left as it was and nothing is left behind next to it. '''
+    temp = path + ".tmp"
+    try:
+        with open(temp, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+class Histogram():
+    ''' Counts durations in buckets that double in size, starting at one microsecond. Bucket n holds durations from
+    2 ** (n - 1) up to 2 ** n microseconds. '''
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = math.frexp(seconds * 1000000)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        ''' Returns the upper edge, in seconds, of the bucket the given fraction of durations fall under. '''
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min(2 ** bucket / 1000000.0, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            'buckets_us': dict((str(2 ** x), self.buckets[x]) for x in sorted(self.buckets)),
+        }
+
+class ServerStats():
+    ''' Everything the relay server keeps track of about itself. '''
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}
+        self.latency = {}
+        self.errors = 0
+        self.busy = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.connections_total = 0
+
+        # Stages of traced messages, timed as they leave the mailbox store.
+        self.trace = {'upload': Histogram(), 'queue': Histogram()}
+
+    def record(self, command, seconds):
+        ''' Counts a handled request and how long it took. '''
+        self.commands[command] = self.commands.get(command, 0) + 1
+        histogram = self.latency.get(command)
+        if histogram is None:
+            histogram = self.latency[command] = Histogram()
+        histogram.record(seconds)
+
+    def traced(self, encrypted, stored, delivered):
+        ''' Records how long a traced message took to reach the server after its sender encrypted it, which depends
+        on the two clocks agreeing, and how long it then waited to be delivered. '''
+        if encrypted is not None:
+            self.trace['upload'].record(max(stored - encrypted, 0.0))
+        self.trace['queue'].record(max(delivered - stored, 0.0))
+
+    def error(self):
+        ''' Counts a request that was answered with 202. '''
+        self.errors += 1
+
+    def turned_away(self):
+        ''' Counts a request or connection that was answered with 300 because the server or the sender was too
+        busy. '''
+        self.busy += 1
+
+    def connection_opened(self):
+        self.connections += 1
+        self.connections_total += 1
+
+    def connection_closed(self):
+        self.connections -= 1
+
+    def snapshot(self, store):
+        ''' Returns the stats, along with how full the mailbox store is, as a dictionairy ready to be sent as JSON. '''
+        top = heapq.nlargest(TOP_RECIPIENTS, store.unread.iteritems(), key=lambda x: x[1])
+        return {
+            'uptime': time.time() - self.started,
+            'commands': self.commands,
+            'errors': self.errors,
+            'busy': self.busy,
+            'latency': dict((x, self.latency[x].to_dict()) for x in self.latency),
+            'trace': dict((x, self.trace[x].to_dict()) for x in self.trace),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'connections': self.connections,
+            'connections_total': self.connections_total,
+            'mailbox': {
+                'messages': store.count,
+                'bytes': store.size,
+                'recipients': len(store.unread),
+                'top_recipients': [{'recipient': printable(x), 'unread': y} for (x, y) in top],
+            },
+        }
+
+    def dump(self, store, path):
+        ''' Writes the stats to a JSON file. '''
+        write_json(self.snapshot(store), path)
+
+def test():
+    import shutil
+    import tempfile
+    from enigma import testit
+    from enigma_mailbox import MailboxStore
+    histogram = Histogram()
+    for x in range(100):
+        histogram.record((x + 1) / 1000.0)
+    testit(histogram.count == 100 and histogram.max == 0.1)
+    testit(0.05 <= histogram.percentile(0.5) <= 0.1 and histogram.percentile(1.0) == 0.1)
+    testit(Histogram().percentile(0.5) == 0.0)
+
+    # Names that aren't UTF-8 still make it into the JSON.
+    store = MailboxStore()
+    store.add("\xff\xfebob", "alice", "hi")
+    stats = ServerStats()
+    stats.record("send", 0.001)
+    data = json.loads(json.dumps(stats.snapshot(store)))
+    testit(data['mailbox']['top_recipients'] == [{'recipient': u"\ufffd\ufffdbob", 'unread': 1}])
+    testit(data['commands'] == {'send': 1} and data['latency']['send']['count'] == 1)
+
+    # A write that fails leaves the old file alone and no temporary file behind.
+    directory = tempfile.mkdtemp(prefix="enigma-stats-test-")
+    try:
+        path = os.path.join(directory, "stats.json")
+        write_json({'a': 1}, path)
+        try:
+            write_json({'a': object()}, path)
+            testit(False)
+        except TypeError:
+            pass
+        testit(json.load(open(path)) == {'a': 1} and os.listdir(directory) == ["stats.json"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
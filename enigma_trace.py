@@ -0,0 +1,177 @@
+######################################################################
+# Author: David Newswanger
+# username: newswangerd
+#
+# Assignment: Final Project
+# Purpose: Traces how long messages take to get from one chat client to another. A small sample of the messages a
+#          client sends carry a trace header, and everything that handles them adds the time it did so:
+#
+#              \x1e<message id>,<encrypted>,<stored>,<delivered>\x1e<cipher text>
+#
+# The sender adds the message id and the time the message was encrypted, and the relay adds the time it was stored
+# and the time it left the store. The recipient takes the header back off and adds up how long each stage took.
+# Cipher text never contains the \x1e marker, so messages without a header cost one startswith() to tell apart.
+#
+######################################################################
+
+import random
+import threading
+import time
+from collections import deque
+from enigma_stats import Histogram, printable, write_json
+
+# Starts and ends the trace header at the front of a traced message.
+TRACE_MARK = "\x1e"
+
+# Every stage a traced message goes through, in order:
+#   encrypt   Encrypting it, timed by the sender.
+#   upload    From being encrypted to being stored on the relay.
+#   queue     Waiting on the relay for the recipient to collect it.
+#   download  From leaving the relay to reaching the recipient.
+#   wait      Waiting for one of the recipient's workers.
+#   decrypt   Decrypting it.
+#   total     From being encrypted to being decrypted.
+# upload, download and total compare clocks on two machines, so they are only as good as those clocks agree.
+STAGES = ("encrypt", "upload", "queue", "download", "wait", "decrypt", "total")
+
+# How many of the most recent traces are kept for exporting.
+RECENT_TRACES = 1000
+
+def relay_stamp(payload, stored, delivered):
+    ''' Adds the time a traced message was stored and the time it left the store to its trace header. Returns the
+    new payload and the time the sender encrypted the message, or None if the header can't be read. '''
+    end = payload.find(TRACE_MARK, 1)
+    if end < 0:
+        return payload, None
+    try:
+        encrypted = float(payload[1:end].split(",")[1])
+    except (IndexError, ValueError):
+        encrypted = None
+    return "%s,%.6f,%.6f%s" % (payload[:end], stored, delivered, payload[end:]), encrypted
+
+def prepend(prefix, payload):
+    ''' Puts prefix in front of a payload, after the trace header if it has one, so the header stays at the very
+    start. '''
+    if payload.startswith(TRACE_MARK):
+        end = payload.find(TRACE_MARK, 1) + 1
+        if end > 0:
+            return payload[:end] + prefix + payload[end:]
+    return prefix + payload
+
+def split_trace(payload):
+    ''' Takes the trace header off a payload. Returns the fields of the header, or None if there isn't one, and
+    the rest of the payload. '''
+    if not payload.startswith(TRACE_MARK):
+        return None, payload
+    end = payload.find(TRACE_MARK, 1)
+    if end < 0:
+        return None, payload
+    return payload[1:end].split(","), payload[end + 1:]
+
+class Tracer():
+    ''' Picks which outgoing messages are traced and keeps a latency histogram for every stage of the traced
+    messages that come in. sample_rate is the fraction of messages traced, so 0.01 traces one in a hundred and 0
+    turns tracing off. Traces from other senders are recorded whatever the rate is. Safe to use from several threads
+    at once. '''
+    def __init__(self, sample_rate=0.0, keep=RECENT_TRACES):
+        self.sample_rate = sample_rate
+        self.stages = dict((x, Histogram()) for x in STAGES)
+        self.recent = deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+        # Message ids are a random prefix for this client and a count, so they don't clash between clients.
+        self.prefix = "%08x" % random.getrandbits(32)
+        self.count = 0
+
+    def sample(self):
+        ''' Whether the next message sent should be traced. '''
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, cipher_text, started):
+        ''' Puts a trace header with a new message id on a message that started being encrypted at started, and
+        records how long encrypting it took. '''
+        encrypted = time.time()
+        with self.lock:
+            self.count += 1
+            message_id = "%s-%d" % (self.prefix, self.count)
+            self.stages["encrypt"].record(encrypted - started)
+        return "%s%s,%.6f%s%s" % (TRACE_MARK, message_id, encrypted, TRACE_MARK, cipher_text)
+
+    def finish(self, fields, sender, received, decrypting, decrypted):
+        ''' Records the stages of a traced message that has just been decrypted. fields is the trace header, and
+        the other times are when the message reached this client, when a worker started decrypting it and when it
+        was done. Stages missing from the header, because it went through an older relay, are left out. '''
+        try:
+            times = [float(x) for x in fields[1:]]
+        except ValueError:
+            return
+
+        durations = {"wait": decrypting - received, "decrypt": decrypted - decrypting}
+        if times:
+            durations["total"] = decrypted - times[0]
+        if len(times) >= 3:
+            # A message moved between shards is stored more than once. It counts as stored when it first got to the
+            # relay and delivered when it finally left it.
+            durations["upload"] = times[1] - times[0]
+            durations["queue"] = times[-1] - times[1]
+            durations["download"] = received - times[-1]
+
+        with self.lock:
+            for (stage, seconds) in durations.iteritems():
+                # Clocks that are slightly out make some stages look like they took less than no time.
+                self.stages[stage].record(max(seconds, 0.0))
+            self.recent.append({'id': printable(fields[0]), 'sender': printable(sender), 'received': received,
+                                'stages': durations})
+
+    def snapshot(self):
+        ''' Returns the histograms and the most recent traces as a dictionairy ready to be written out as JSON. '''
+        with self.lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'stages': dict((x, self.stages[x].to_dict()) for x in STAGES),
+                'recent': list(self.recent),
+            }
+
+    def summary(self):
+        ''' Returns one line for every stage that has been seen, with its count and percentiles in milliseconds. '''
+        lines = []
+        with self.lock:
+            for stage in STAGES:
+                histogram = self.stages[stage]
+                if histogram.count == 0:
+                    continue
+                lines.append("%-9s %6d messages  p50 %8.1f ms  p90 %8.1f ms  p99 %8.1f ms  max %8.1f ms" % (
+                    stage, histogram.count, histogram.percentile(0.5) * 1000, histogram.percentile(0.9) * 1000,
+                    histogram.percentile(0.99) * 1000, histogram.max * 1000))
+        return lines
+
+    def dump(self, path):
+        ''' Writes the histograms and the most recent traces to a JSON file. '''
+        write_json(self.snapshot(), path)
+
+def test():
+    import json
+    import os
+    import shutil
+    import tempfile
+    from enigma import testit
+    testit(split_trace("plain") == (None, "plain"))
+    payload = "%sabc-1,100.000000%scipher" % (TRACE_MARK, TRACE_MARK)
+    (stamped, encrypted) = relay_stamp(payload, 101.0, 103.0)
+    testit(encrypted == 100.0)
+    testit(split_trace(prepend("alice\t", stamped)) == (["abc-1", "100.000000", "101.000000", "103.000000"],
+                                                         "alice\tcipher"))
+
+    # Stages come from the header and the times the recipient saw, and odd names still make it into the JSON.
+    tracer = Tracer()
+    (fields, rest) = split_trace(stamped)
+    tracer.finish(fields, "\xffalice", 104.0, 105.0, 105.5)
+    testit([x for x in STAGES if tracer.stages[x].count] == list(STAGES[1:]))
+    testit(tracer.stages["queue"].max == 2.0 and tracer.stages["total"].max == 5.5)
+    directory = tempfile.mkdtemp(prefix="enigma-trace-test-")
+    try:
+        path = os.path.join(directory, "trace.json")
+        tracer.dump(path)
+        testit(json.load(open(path))['recent'][0]['sender'] == u"\ufffdalice")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)